@@ -29,7 +29,7 @@ def main(args):
   scenes = []
   split = None
   for filename in os.listdir(args.input_dir):
-    if not filename.endswith('.json'):
+    if not filename.endswith('.json') or filename == 'info.json':
       continue
     path = os.path.join(args.input_dir, filename)
     with open(path, 'r') as f:
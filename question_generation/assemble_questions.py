@@ -0,0 +1,68 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json
+
+import json_stream
+
+"""
+Convert questions written as JSON Lines by generate_questions.py (with
+--output_questions_file ending in .jsonl) to the single-file format of the
+CLEVR release, {"info": {...}, "questions": [...]}. The output is the same as
+if generate_questions.py had written the single-file format directly.
+
+Several JSON Lines files (for example from runs over different ranges of
+scenes) can be combined into one output file; in that case the info is taken
+from the first file and questions are renumbered in order. Questions are
+streamed, so this does not need to hold the dataset in memory.
+"""
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_files', nargs='+', required=True,
+    help="JSON Lines question files from generate_questions.py")
+parser.add_argument('--output_file', required=True,
+    help="JSON file to write")
+
+
+def iter_jsonl_questions(filename):
+  """
+  Return a tuple (info, questions) for a JSON Lines question file, where
+  questions is an iterator over the questions in the file.
+  """
+  lines = json_stream.iter_jsonl(filename)
+  first = next(lines, None)
+  if first is None or 'info' not in first or 'question' in first:
+    raise ValueError('%s does not start with an info line' % filename)
+  return first['info'], lines
+
+
+def main(args):
+  info = None
+  num_questions = 0
+  renumber = len(args.input_files) > 1
+  with open(args.output_file, 'w') as out:
+    for filename in args.input_files:
+      file_info, questions = iter_jsonl_questions(filename)
+      if info is None:
+        info = file_info
+        out.write('{"info": %s, "questions": [' % json.dumps(info))
+      for q in questions:
+        if renumber:
+          q['question_index'] = num_questions
+        if num_questions > 0:
+          out.write(', ')
+        out.write(json.dumps(q))
+        num_questions += 1
+    out.write(']}')
+  print('Wrote %d questions to %s' % (num_questions, args.output_file))
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -6,11 +6,16 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import argparse, json, os, itertools, random, shutil
+import argparse, json, os, itertools, random, shutil, sys, pickle
 import time
 import re
+import multiprocessing, queue
+from collections import deque
 
 import question_engine as qeng
+import json_stream
+from question_writer import QuestionWriter
+import template_compiler
 
 """
 Generate synthetic questions and answers for CLEVR images. Input is a single
@@ -47,18 +52,32 @@ parser = argparse.ArgumentParser()
 # Inputs
 parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py. This may also be a JSON Lines file (ending " +
+         "in .jsonl) with one scene per line, optionally preceded by a line " +
+         "of the form {\"info\": ...}, or a directory of per-scene JSON " +
+         "files as written by render_images.py. Scenes are read " +
+         "incrementally in all cases.")
 parser.add_argument('--metadata_file', default='metadata.json',
     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='synonyms.json',
     help="JSON file defining synonyms for parameter values")
 parser.add_argument('--template_dir', default='CLEVR_1.0_templates',
     help="Directory containing JSON templates for questions")
+parser.add_argument('--template_cache_file', default=None,
+    help="File in which compiled templates are cached between runs; " +
+         "defaults to a file in clevr_question_generation in the user's " +
+         "cache directory ($XDG_CACHE_HOME or ~/.cache)")
+parser.add_argument('--no_template_cache', action='store_true',
+    help="If given then compile templates without reading or writing " +
+         "the template cache")
 
 # Output
 parser.add_argument('--output_questions_file',
     default='../output/CLEVR_questions.json',
-    help="The output file to write containing generated questions")
+    help="The output file to write containing generated questions. " +
+         "Questions are written as they are generated; if the filename ends " +
+         "in .jsonl then they are written as JSON Lines, with the info " +
+         "on the first line and one question per line after it.")
 
 # Control which and how many images to process
 parser.add_argument('--scene_start_idx', default=0, type=int,
@@ -82,12 +101,30 @@ parser.add_argument('--reset_counts_every', default=250, type=int,
     help="How often to reset template and answer counts. Higher values will " +
          "result in flatter distributions over templates and answers, but " +
          "will result in longer runtimes.")
+parser.add_argument('--workers', default=0, type=int,
+    help="If greater than 0, generate questions in this many worker " +
+         "processes; template and answer counts are shared between them")
+parser.add_argument('--scenes_per_chunk', default=8, type=int,
+    help="Number of scenes handed to a worker at once with --workers")
+parser.add_argument('--checkpoint_every', default=0, type=int,
+    help="If greater than 0, save a checkpoint after every this many " +
+         "scenes, from which the run can be continued with --resume")
+parser.add_argument('--checkpoint_file', default=None,
+    help="Where to save checkpoints; defaults to the output file with " +
+         "'.checkpoint' appended")
+parser.add_argument('--resume', action='store_true',
+    help="If given and a checkpoint exists, continue the run from the " +
+         "checkpoint, producing the same output as an uninterrupted run. " +
+         "Requires the same arguments as the interrupted run.")
 parser.add_argument('--verbose', action='store_true',
     help="Print more verbose output")
 parser.add_argument('--time_dfs', action='store_true',
     help="Time each depth-first search; must be given with --verbose")
 parser.add_argument('--profile', action='store_true',
     help="If given then run inside cProfile")
+parser.add_argument('--profile_handlers', action='store_true',
+    help="If given then print the number of calls, time, and output sizes " +
+         "of the execute handlers for each node type")
 # args = parser.parse_args()
 
 
@@ -127,20 +164,54 @@ def precompute_filter_options(scene_struct, metadata):
         attribute_map[masked_key].add(object_idx)
 
   scene_struct['_filter_options'] = attribute_map
+  # The same options with the matching objects as bitmasks, and caches for
+  # get_filter_option_index and get_relate_filter_option_table
+  scene_struct['_filter_option_masks'] = [(k, qeng.list_to_mask(vs))
+                                          for k, vs in attribute_map.items()]
+  scene_struct['_filter_option_index'] = {}
+  scene_struct['_relate_filter_tables'] = {}
+  scene_struct['_relate_filter_views'] = {}
 
 
-def find_filter_options(object_idxs, scene_struct, metadata):
-  # Keys are tuples (size, color, shape, material) (where some may be None)
-  # and values are lists of object idxs that match the filter criterion
-
+def get_filter_option_index(object_idxs, scene_struct, metadata):
+  """
+  Return a tuple (options, unique_options, num_singletons) describing the
+  filter options for the objects object_idxs. options maps each key of
+  scene_struct['_filter_options'], in the same order, to the sorted list of
+  objects in object_idxs that match it; unique_options holds the options
+  matching exactly one object, and num_singletons is their number.
+
+  Results are cached in the scene for each set of objects, so they must not
+  be modified; find_filter_options returns a copy that may be.
+  """
   if '_filter_options' not in scene_struct:
     precompute_filter_options(scene_struct, metadata)
 
-  attribute_map = {}
-  object_idxs = set(object_idxs)
-  for k, vs in scene_struct['_filter_options'].items():
-    attribute_map[k] = sorted(list(object_idxs & vs))
-  return attribute_map
+  input_mask = qeng.list_to_mask(object_idxs)
+  cache = scene_struct['_filter_option_index']
+  index = cache.get(input_mask)
+  if index is None:
+    # Options that select the same objects share one list
+    lists = {}
+    options, unique_options = {}, {}
+    for k, mask in scene_struct['_filter_option_masks']:
+      mask &= input_mask
+      objs = lists.get(mask)
+      if objs is None:
+        objs = qeng.mask_to_list(mask)
+        lists[mask] = objs
+      options[k] = objs
+      if len(objs) == 1:
+        unique_options[k] = objs
+    index = (options, unique_options, len(unique_options))
+    cache[input_mask] = index
+  return index
+
+
+def find_filter_options(object_idxs, scene_struct, metadata):
+  # Keys are tuples (size, color, shape, material) (where some may be None)
+  # and values are lists of object idxs that match the filter criterion
+  return dict(get_filter_option_index(object_idxs, scene_struct, metadata)[0])
 
 
 def add_empty_filter_options(attribute_map, metadata, num_to_add):
@@ -162,31 +233,74 @@ def add_empty_filter_options(attribute_map, metadata, num_to_add):
       attribute_map[k] = []
 
 
-def find_relate_filter_options(object_idx, scene_struct, metadata,
-    unique=False, include_zero=False, trivial_frac=0.1):
-  options = {}
+def get_relate_filter_option_table(object_idx, scene_struct, metadata,
+    unique=False, include_zero=False):
+  """
+  Return a tuple (options, trivial_options) giving the relate filter options
+  for the object object_idx. options maps keys (relationship, filters) to the
+  sorted list of objects that are related to object_idx and match filters,
+  for the nontrivial options (where some object matching filters is not
+  related); trivial_options is a list of (key, objects) pairs for the others.
+  If unique is True then only options selecting one object are included, and
+  unless include_zero is True options selecting no objects are left out.
+  Keys are in the order of scene_struct['relationships'] and
+  scene_struct['_filter_options'].
+
+  Every option for an object is worked out the first time the object is
+  seen, and the results for each combination of unique and include_zero are
+  cached in the scene, so they must not be modified.
+  """
   if '_filter_options' not in scene_struct:
     precompute_filter_options(scene_struct, metadata)
 
+  views = scene_struct['_relate_filter_views']
+  view_key = (object_idx, unique, include_zero)
+  view = views.get(view_key)
+  if view is not None:
+    return view
+
+  tables = scene_struct['_relate_filter_tables']
+  table = tables.get(object_idx)
+  if table is None:
+    # Tuples (key, objects, trivial) for every relationship and filter
+    table = []
+    lists = {}
+    for relationship, related in scene_struct['relationships'].items():
+      related_mask = qeng.list_to_mask(related[object_idx])
+      for filters, filtered_mask in scene_struct['_filter_option_masks']:
+        mask = related_mask & filtered_mask
+        objs = lists.get(mask)
+        if objs is None:
+          objs = qeng.mask_to_list(mask)
+          lists[mask] = objs
+        table.append(((relationship, filters), objs, mask == filtered_mask))
+    tables[object_idx] = table
+
+  options, trivial_options = {}, []
+  for key, objs, trivial in table:
+    if unique and len(objs) != 1: continue
+    if not include_zero and len(objs) == 0: continue
+    if trivial:
+      trivial_options.append((key, objs))
+    else:
+      options[key] = objs
+  view = (options, trivial_options)
+  views[view_key] = view
+  return view
+
+
+def find_relate_filter_options(object_idx, scene_struct, metadata,
+    unique=False, include_zero=False, trivial_frac=0.1):
   # TODO: Right now this is only looking for nontrivial combinations; in some
   # cases I may want to add trivial combinations, either where the intersection
   # is empty or where the intersection is equal to the filtering output.
-  trivial_options = {}
-  for relationship in scene_struct['relationships']:
-    related = set(scene_struct['relationships'][relationship][object_idx])
-    for filters, filtered in scene_struct['_filter_options'].items():
-      intersection = related & filtered
-      trivial = (intersection == filtered)
-      if unique and len(intersection) != 1: continue
-      if not include_zero and len(intersection) == 0: continue
-      if trivial:
-        trivial_options[(relationship, filters)] = sorted(list(intersection))
-      else:
-        options[(relationship, filters)] = sorted(list(intersection))
+  options, trivial_options = get_relate_filter_option_table(object_idx,
+      scene_struct, metadata, unique=unique, include_zero=include_zero)
+  options = dict(options)
 
   N, f = len(options), trivial_frac
   num_trivial = int(round(N * f / (1 - f)))
-  trivial_options = list(trivial_options.items())
+  trivial_options = list(trivial_options)
   random.shuffle(trivial_options)
   for k, v in trivial_options[:num_trivial]:
     options[k] = v
@@ -194,16 +308,6 @@ def find_relate_filter_options(object_idx, scene_struct, metadata,
   return options
 
 
-def node_shallow_copy(node):
-  new_node = {
-    'type': node['type'],
-    'inputs': node['inputs'],
-  }
-  if 'side_inputs' in node:
-    new_node['side_inputs'] = node['side_inputs']
-  return new_node
-
-
 def other_heuristic(text, param_vals):
   """
   Post-processing heuristic to handle the word "other"
@@ -239,84 +343,261 @@ def other_heuristic(text, param_vals):
   return text
 
 
-def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
-                              synonyms, max_instances=None, verbose=False):
+class AnswerCounter(object):
+  """
+  Counts how many questions of a template have each possible answer, for the
+  rejection sampling heuristics in instantiate_templates_dfs.
 
-  param_name_to_type = {p['name']: p['type'] for p in template['params']} 
+  The counts are kept sorted, together with the position of each answer in
+  the sorted order and the last position of each count, so that incrementing
+  a count only swaps two entries and the median and the second largest count
+  can be read off directly.
+  """
+  def __init__(self, answers):
+    self.answers = []  # Answers in order of increasing count
+    self.counts = []  # Sorted counts; counts[i] is the count of answers[i]
+    self.positions = {}  # Maps each answer to its index in answers
+    for answer in answers:
+      if answer not in self.positions:
+        self.positions[answer] = len(self.answers)
+        self.answers.append(answer)
+        self.counts.append(0)
+    # Maps each count to the last index in counts where it appears
+    self.last_index = {0: len(self.counts) - 1} if self.counts else {}
+
+  def __getitem__(self, answer):
+    return self.counts[self.positions[answer]]
+
+  def __len__(self):
+    return len(self.counts)
+
+  def items(self):
+    return [(answer, self.counts[i]) for answer, i in self.positions.items()]
+
+  def copy(self):
+    other = AnswerCounter([])
+    other.answers = list(self.answers)
+    other.counts = list(self.counts)
+    other.positions = dict(self.positions)
+    other.last_index = dict(self.last_index)
+    return other
+
+  def increment(self, answer):
+    i = self.positions[answer]
+    count = self.counts[i]
+    # Swap answer with the last answer having the same count, so that
+    # incrementing the count keeps counts sorted
+    j = self.last_index[count]
+    other_answer = self.answers[j]
+    self.answers[i], self.answers[j] = other_answer, answer
+    self.positions[other_answer], self.positions[answer] = i, j
+    self.counts[j] = count + 1
+    if j > 0 and self.counts[j - 1] == count:
+      self.last_index[count] = j - 1
+    else:
+      del self.last_index[count]
+    if count + 1 not in self.last_index:
+      self.last_index[count + 1] = j
 
-  initial_state = {
-    'nodes': [node_shallow_copy(template['nodes'][0])],
-    'vals': {},
-    'input_map': {0: 0},
-    'next_template_node': 1,
-  }
+  def add(self, answer, amount):
+    for _ in range(amount):
+      self.increment(answer)
+
+  def median(self):
+    """
+    Return the count at index len(self) // 2 in sorted order.
+    """
+    return self.counts[len(self.counts) // 2]
+
+  def second_largest(self):
+    return self.counts[-2]
+
+
+class DFSState(object):
+  """
+  A partial instantiation of a template during the DFS.
+
+  States are persistent: each state stores only what it adds to its parent
+  (the program nodes it appends, the parameter values it assigns, and the
+  program node that the template node it expands maps to), so creating a
+  child takes constant time and memory no matter how long the program is.
+  The full program and parameter values are only built when they are asked
+  for, from those of the parent, and are then kept for the children of this
+  state.
+
+  Once a state has been evaluated, outputs and node_keys hold the outputs and
+  sub-program keys of its whole program (as returned by
+  question_engine.answer_question_incremental), so that its children only
+  need to evaluate the nodes they append.
+  """
+  __slots__ = ['parent', 'new_nodes', 'num_nodes', 'new_vals',
+               'template_node', 'output_idx', 'next_template_node', 'answer',
+               'outputs', 'node_keys', '_nodes', '_vals']
+
+  def __init__(self, parent, new_nodes, new_vals, output_idx):
+    self.parent = parent
+    self.new_nodes = new_nodes
+    self.new_vals = new_vals
+    self.output_idx = output_idx
+    self.answer = None
+    self.outputs = None
+    self.node_keys = None
+    self._nodes = None
+    self._vals = None
+    if parent is None:
+      self.num_nodes = len(new_nodes)
+      self.template_node = 0
+    else:
+      self.num_nodes = parent.num_nodes + len(new_nodes)
+      self.template_node = parent.next_template_node
+    self.next_template_node = self.template_node + 1
+
+  def get_nodes(self):
+    """
+    Return the program for this state as a list of nodes; it should not be
+    modified.
+    """
+    if self._nodes is None:
+      if self.parent is None:
+        self._nodes = list(self.new_nodes)
+      else:
+        self._nodes = self.parent.get_nodes() + list(self.new_nodes)
+    return self._nodes
+
+  def get_vals(self):
+    """
+    Return a dict of all parameter values assigned so far, in the order in
+    which they were assigned; it should not be modified.
+    """
+    if self._vals is None:
+      if self.parent is None:
+        vals = {}
+      else:
+        vals = self.parent.get_vals()
+      if self.new_vals:
+        vals = dict(vals)
+        for name, val in self.new_vals:
+          vals[name] = val
+      self._vals = vals
+    return self._vals
+
+  def get_input(self, template_node):
+    """
+    Return the index of the program node that the output of template_node
+    maps to, or None if template_node has not been expanded yet.
+    """
+    state = self
+    while state is not None:
+      if state.template_node == template_node:
+        return state.output_idx
+      state = state.parent
+    return None
+
+
+def violates_param_constraints(template, state, new_vals, verbose=False):
+  """
+  Check whether assigning new_vals, a list of pairs (param_name, value), in a
+  child of state would violate a NEQ or NULL constraint of template. Only
+  constraints on the newly assigned parameters are checked, since the others
+  were checked when their parameters were assigned.
+  """
+  vals = None
+  for name, val in new_vals:
+    for constraint in template.param_constraints.get(name, ()):
+      if constraint[0] == 'NULL':
+        if val != constraint[2]:
+          if verbose:
+            print('skipping due to NULL constraint')
+            print(constraint)
+            print(new_vals)
+          return True
+      else:
+        if vals is None:
+          vals = dict(state.get_vals())
+          vals.update(new_vals)
+        v1, v2 = vals.get(constraint[1]), vals.get(constraint[2])
+        if v1 is not None and v2 is not None and v1 != v2:
+          if verbose:
+            print('skipping due to NEQ constraint')
+            print(constraint)
+            print(vals)
+          return True
+  return False
+
+
+_unknown = object()
+
+
+def predict_filter_output(extra_type, objs):
+  """
+  Return the output of a special template node whose filters select the
+  objects objs and that ends with a node of type extra_type (or no extra node
+  if extra_type is None), or _unknown if the node would be invalid.
+  """
+  if extra_type == 'count':
+    return len(objs)
+  elif extra_type == 'exist':
+    return len(objs) > 0
+  elif extra_type == 'unique':
+    return objs[0] if len(objs) == 1 else _unknown
+  return objs
+
+
+def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
+                              synonyms, max_instances=None, verbose=False):
+  """
+  Instantiate template, a template_compiler.CompiledTemplate, on a scene.
+  answer_counts is the AnswerCounter for the template, which is updated with
+  the answers of the questions that are returned.
+  """
+  initial_state = DFSState(None, (template.nodes[0],), (), 0)
   states = [initial_state]
   final_states = []
   while states:
     state = states.pop()
 
-    # Check to make sure the current state is valid
-    q = {'nodes': state['nodes']}
-    outputs = qeng.answer_question(q, metadata, scene_struct, all_outputs=True)
+    # Check to make sure the current state is valid; only the nodes added by
+    # this state need to be evaluated, since its parent was evaluated already
+    parent = state.parent
+    if parent is None:
+      outputs, node_keys = qeng.answer_question_incremental(
+          state.new_nodes, metadata, scene_struct)
+    else:
+      outputs, node_keys = qeng.answer_question_incremental(
+          state.new_nodes, metadata, scene_struct, parent.outputs,
+          parent.node_keys)
     answer = outputs[-1]
     if answer == '__INVALID__': continue
+    state.outputs = outputs
+    state.node_keys = node_keys
 
-    # Check to make sure constraints are satisfied for the current state
+    # Constraints on parameter values were checked when this state was
+    # created, and OUT_NEQ constraints on earlier template nodes were checked
+    # for its ancestors, so only OUT_NEQ constraints completed by the template
+    # node that this state expanded remain to be checked
     skip_state = False
-    for constraint in template['constraints']:
-      if constraint['type'] == 'NEQ':
-        p1, p2 = constraint['params']
-        v1, v2 = state['vals'].get(p1), state['vals'].get(p2)
-        if v1 is not None and v2 is not None and v1 != v2:
-          if verbose:
-            print('skipping due to NEQ constraint')
-            print(constraint)
-            print(state['vals'])
-          skip_state = True
-          break
-      elif constraint['type'] == 'NULL':
-        p = constraint['params'][0]
-        p_type = param_name_to_type[p]
-        v = state['vals'].get(p)
-        if v is not None:
-          skip = False
-          if p_type == 'Shape' and v != 'thing': skip = True
-          if p_type != 'Shape' and v != '': skip = True
-          if skip:
-            if verbose:
-              print('skipping due to NULL constraint')
-              print(constraint)
-              print(state['vals'])
-            skip_state = True
-            break
-      elif constraint['type'] == 'OUT_NEQ':
-        i, j = constraint['params']
-        i = state['input_map'].get(i, None)
-        j = state['input_map'].get(j, None)
-        if i is not None and j is not None and outputs[i] == outputs[j]:
-          if verbose:
-            print('skipping due to OUT_NEQ constraint')
-            print(outputs[i])
-            print(outputs[j])
-          skip_state = True
-          break
-      else:
-        assert False, 'Unrecognized constraint type "%s"' % constraint['type']
-
+    for j in template.output_constraints.get(state.template_node, ()):
+      i = state.get_input(j)
+      if i is not None and outputs[state.output_idx] == outputs[i]:
+        if verbose:
+          print('skipping due to OUT_NEQ constraint')
+          print(outputs[state.output_idx])
+          print(outputs[i])
+        skip_state = True
+        break
     if skip_state:
       continue
 
     # We have already checked to make sure the answer is valid, so if we have
     # processed all the nodes in the template then the current state is a valid
     # question, so add it if it passes our rejection sampling tests.
-    if state['next_template_node'] == len(template['nodes']):
+    if state.next_template_node == len(template.nodes):
       # Use our rejection sampling heuristics to decide whether we should
       # keep this template instantiation
       cur_answer_count = answer_counts[answer]
-      answer_counts_sorted = sorted(answer_counts.values())
-      median_count = answer_counts_sorted[len(answer_counts_sorted) // 2]
+      median_count = answer_counts.median()
       median_count = max(median_count, 5)
-      if cur_answer_count > 1.1 * answer_counts_sorted[-2]:
+      if cur_answer_count > 1.1 * answer_counts.second_largest():
         if verbose: print('skipping due to second count')
         continue
       if cur_answer_count > 5.0 * median_count:
@@ -325,179 +606,204 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
 
       # If the template contains a raw relate node then we need to check for
       # degeneracy at the end
-      has_relate = any(n['type'] == 'relate' for n in template['nodes'])
-      if has_relate:
+      if template.has_relate:
+        q = {'nodes': state.get_nodes()}
         degen = qeng.is_degenerate(q, metadata, scene_struct, answer=answer,
-                                   verbose=verbose)
+                                   verbose=verbose, outputs=outputs)
         if degen:
           continue
 
-      answer_counts[answer] += 1
-      state['answer'] = answer
+      answer_counts.increment(answer)
+      state.answer = answer
       final_states.append(state)
       if max_instances is not None and len(final_states) == max_instances:
         break
       continue
 
     # Otherwise fetch the next node from the template
-    # Make a shallow copy so cached _outputs don't leak ... this is very nasty
-    next_node = template['nodes'][state['next_template_node']]
-    next_node = node_shallow_copy(next_node)
-
-    special_nodes = {
-        'filter_unique', 'filter_count', 'filter_exist', 'filter',
-        'relate_filter', 'relate_filter_unique', 'relate_filter_count',
-        'relate_filter_exist',
-    }
-    if next_node['type'] in special_nodes:
-      if next_node['type'].startswith('relate_filter'):
-        unique = (next_node['type'] == 'relate_filter_unique')
-        include_zero = (next_node['type'] == 'relate_filter_count'
-                        or next_node['type'] == 'relate_filter_exist')
+    next_node = template.nodes[state.next_template_node]
+    expansion = template.expansions[state.next_template_node]
+
+    if expansion['kind'] == 'special':
+      node_type = expansion['type']
+      if expansion['relate_param'] is not None:
         filter_options = find_relate_filter_options(answer, scene_struct, metadata,
-                            unique=unique, include_zero=include_zero)
+                            unique=expansion['unique'],
+                            include_zero=expansion['include_zero'])
       else:
-        filter_options = find_filter_options(answer, scene_struct, metadata)
-        if next_node['type'] == 'filter':
-          # Remove null filter
-          filter_options.pop((None, None, None, None), None)
-        if next_node['type'] == 'filter_unique':
-          # Get rid of all filter options that don't result in a single object
-          filter_options = {k: v for k, v in filter_options.items()
-                            if len(v) == 1}
+        all_options, unique_options, num_singletons = get_filter_option_index(
+            answer, scene_struct, metadata)
+        if node_type == 'filter_unique':
+          # Only keep filter options that result in a single object; these
+          # are not modified, so the cached dict can be used directly
+          filter_options = unique_options
         else:
+          filter_options = dict(all_options)
+          if node_type == 'filter':
+            # Remove null filter
+            null_objs = filter_options.pop((None, None, None, None), None)
+            if null_objs is not None and len(null_objs) == 1:
+              num_singletons -= 1
           # Add some filter options that do NOT correspond to the scene
-          if next_node['type'] == 'filter_exist':
+          if node_type == 'filter_exist':
             # For filter_exist we want an equal number that do and don't
             num_to_add = len(filter_options)
-          elif next_node['type'] == 'filter_count' or next_node['type'] == 'filter':
+          elif node_type == 'filter_count' or node_type == 'filter':
             # For filter_count add nulls equal to the number of singletons
-            num_to_add = sum(1 for k, v in filter_options.items() if len(v) == 1)
+            num_to_add = num_singletons
           add_empty_filter_options(filter_options, metadata, num_to_add)
 
       filter_option_keys = list(filter_options.keys())
       random.shuffle(filter_option_keys)
+      template_input = state.get_input(next_node['inputs'][0])
+      relate_param = expansion['relate_param']
+      filter_params = expansion['filter_params']
+      extra_type = expansion['extra_type']
+
+      # If the output of this template node must differ from those of earlier
+      # nodes then we can often tell from the filter options which children
+      # would violate this, without evaluating them. The options were found
+      # from the objects in answer, so this only works if the template node
+      # takes answer as its input; unless the objects are then counted or
+      # checked for existence or uniqueness the options must also list them
+      # in the order the filters would output them.
+      out_neq_outputs = None
+      out_neq_nodes = template.output_constraints.get(state.next_template_node)
+      if (out_neq_nodes and template_input == state.num_nodes - 1 and
+          (extra_type is not None or
+           (relate_param is None and answer == sorted(answer)))):
+        out_neq_outputs = [outputs[state.get_input(j)] for j in out_neq_nodes]
+
       for k in filter_option_keys:
+        objs = filter_options[k]
+        # Keys added by add_empty_filter_options are generators that draw
+        # random values, and do not correspond to objs
+        predictable = isinstance(k, tuple)
+        cur_next_vals = []
+        if relate_param is not None:
+          relate_val, k = k
+          cur_next_vals.append((relate_param, relate_val))
+        # Draw the values of generator keys now, as many as zip would draw
+        param_vals = tuple(itertools.islice(k, len(filter_params)))
+        for (param_name, _, null_value), param_val in zip(filter_params,
+                                                         param_vals):
+          if param_val is None:
+            param_val = null_value
+          cur_next_vals.append((param_name, param_val))
+        if (template.param_constraints and
+            violates_param_constraints(template, state, cur_next_vals,
+                                       verbose)):
+          continue
+        if out_neq_outputs is not None and predictable:
+          output = predict_filter_output(extra_type, objs)
+          if (output is not _unknown and
+              any(output == o for o in out_neq_outputs)):
+            if verbose:
+              print('skipping due to OUT_NEQ constraint')
+              print(output)
+            continue
+
         new_nodes = []
-        cur_next_vals = {k: v for k, v in state['vals'].items()}
-        next_input = state['input_map'][next_node['inputs'][0]]
-        filter_side_inputs = next_node['side_inputs']
-        if next_node['type'].startswith('relate'):
-          param_name = next_node['side_inputs'][0] # First one should be relate
-          filter_side_inputs = next_node['side_inputs'][1:]
-          param_type = param_name_to_type[param_name]
-          assert param_type == 'Relation'
-          param_val = k[0]
-          k = k[1]
+        next_input = template_input
+        if relate_param is not None:
           new_nodes.append({
             'type': 'relate',
             'inputs': [next_input],
-            'side_inputs': [param_val],
+            'side_inputs': [relate_val],
           })
-          cur_next_vals[param_name] = param_val
-          next_input = len(state['nodes']) + len(new_nodes) - 1
-        for param_name, param_val in zip(filter_side_inputs, k):
-          param_type = param_name_to_type[param_name]
-          filter_type = 'filter_%s' % param_type.lower()
+          next_input = state.num_nodes + len(new_nodes) - 1
+        for (_, filter_type, _), param_val in zip(filter_params, param_vals):
           if param_val is not None:
             new_nodes.append({
               'type': filter_type,
               'inputs': [next_input],
               'side_inputs': [param_val],
             })
-            cur_next_vals[param_name] = param_val
-            next_input = len(state['nodes']) + len(new_nodes) - 1
-          elif param_val is None:
-            if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
-              param_val = 'thing'
-            else:
-              param_val = ''
-            cur_next_vals[param_name] = param_val
-        input_map = {k: v for k, v in state['input_map'].items()}
-        extra_type = None
-        if next_node['type'].endswith('unique'):
-          extra_type = 'unique'
-        if next_node['type'].endswith('count'):
-          extra_type = 'count'
-        if next_node['type'].endswith('exist'):
-          extra_type = 'exist'
+            next_input = state.num_nodes + len(new_nodes) - 1
         if extra_type is not None:
           new_nodes.append({
             'type': extra_type,
-            'inputs': [input_map[next_node['inputs'][0]] + len(new_nodes)],
+            'inputs': [template_input + len(new_nodes)],
           })
-        input_map[state['next_template_node']] = len(state['nodes']) + len(new_nodes) - 1
-        states.append({
-          'nodes': state['nodes'] + new_nodes,
-          'vals': cur_next_vals,
-          'input_map': input_map,
-          'next_template_node': state['next_template_node'] + 1,
-        })
-
-    elif 'side_inputs' in next_node:
-      # If the next node has template parameters, expand them out
-      # TODO: Generalize this to work for nodes with more than one side input
-      assert len(next_node['side_inputs']) == 1, 'NOT IMPLEMENTED'
+        states.append(DFSState(state, new_nodes, cur_next_vals,
+                               state.num_nodes + len(new_nodes) - 1))
 
+    elif expansion['kind'] == 'param':
+      # If the next node has template parameters, expand them out.
       # Use metadata to figure out domain of valid values for this parameter.
       # Iterate over the values in a random order; then it is safe to bail
       # from the DFS as soon as we find the desired number of valid template
       # instantiations.
-      param_name = next_node['side_inputs'][0]
-      param_type = param_name_to_type[param_name]
-      param_vals = metadata['types'][param_type][:]
+      param_name = expansion['param_name']
+      param_vals = expansion['param_vals'][:]
       random.shuffle(param_vals)
+      inputs = [state.get_input(idx) for idx in next_node['inputs']]
       for val in param_vals:
-        input_map = {k: v for k, v in state['input_map'].items()}
-        input_map[state['next_template_node']] = len(state['nodes'])
+        cur_next_vals = ((param_name, val),)
+        if (template.param_constraints and
+            violates_param_constraints(template, state, cur_next_vals,
+                                       verbose)):
+          continue
         cur_next_node = {
           'type': next_node['type'],
-          'inputs': [input_map[idx] for idx in next_node['inputs']],
+          'inputs': inputs,
           'side_inputs': [val],
         }
-        cur_next_vals = {k: v for k, v in state['vals'].items()}
-        cur_next_vals[param_name] = val
-
-        states.append({
-          'nodes': state['nodes'] + [cur_next_node],
-          'vals': cur_next_vals,
-          'input_map': input_map,
-          'next_template_node': state['next_template_node'] + 1,
-        })
+        states.append(DFSState(state, (cur_next_node,), cur_next_vals,
+                               state.num_nodes))
     else:
-      input_map = {k: v for k, v in state['input_map'].items()}
-      input_map[state['next_template_node']] = len(state['nodes'])
       next_node = {
         'type': next_node['type'],
-        'inputs': [input_map[idx] for idx in next_node['inputs']],
+        'inputs': [state.get_input(idx) for idx in next_node['inputs']],
       }
-      states.append({
-        'nodes': state['nodes'] + [next_node],
-        'vals': state['vals'],
-        'input_map': input_map,
-        'next_template_node': state['next_template_node'] + 1,
-      })
+      states.append(DFSState(state, (next_node,), (), state.num_nodes))
 
   # Actually instantiate the template with the solutions we've found
   text_questions, structured_questions, answers = [], [], []
   for state in final_states:
-    structured_questions.append(state['nodes'])
-    answers.append(state['answer'])
-    text = random.choice(template['text'])
-    for name, val in state['vals'].items():
+    structured_questions.append(state.get_nodes())
+    answers.append(state.answer)
+    vals = state.get_vals()
+    text, tokens = random.choice(template.text_templates)
+    param_text = {}
+    for name, val in vals.items():
       if val in synonyms:
         val = random.choice(synonyms[val])
-      text = text.replace(name, val)
+      param_text[name] = val
+    if tokens is not None:
+      text = fill_text_tokens(tokens, param_text)
+    else:
+      for name, val in param_text.items():
+        text = text.replace(name, val)
+        text = ' '.join(text.split())
+      text = replace_optionals(text)
       text = ' '.join(text.split())
-    text = replace_optionals(text)
-    text = ' '.join(text.split())
-    text = other_heuristic(text, state['vals'])
+    text = other_heuristic(text, vals)
     text_questions.append(text)
 
   return text_questions, structured_questions, answers
 
 
 
+def fill_text_tokens(tokens, param_text):
+  """
+  Fill in a text template that was split up by template_compiler.tokenize_text,
+  replacing parameter names by their text in param_text and dropping each
+  optional segment with probability 0.5; the result (and the use of random)
+  is the same as replacing the parameters in the text template, calling
+  replace_optionals and normalizing whitespace.
+  """
+  pieces = []
+  for optional, parts in tokens:
+    if optional and not random.random() > 0.5:
+      continue
+    for is_param, s in parts:
+      if is_param:
+        s = param_text.get(s, s)
+      pieces.append(s)
+  return ' '.join(''.join(pieces).split())
+
+
 def replace_optionals(s):
   """
   Each substring of s that is surrounded in square brackets is treated as
@@ -529,6 +835,274 @@ def replace_optionals(s):
   return s
 
 
+def format_progress(i, total):
+  if total is None:
+    return '%d' % (i + 1)
+  return '%d / %d' % (i + 1, total)
+
+
+def generate_scene_questions(scene_struct, templates, metadata, synonyms,
+                             template_counts, template_answer_counts,
+                             scene_info, args):
+  """
+  Instantiate templates on a single scene, updating template_counts and
+  template_answer_counts. Returns a list of questions; their question_index
+  is assigned when they are written.
+  """
+  questions = []
+  # Strings repeated in every question are shared between them
+  split = sys.intern(scene_info['split'])
+  scene_fn = sys.intern(scene_struct['image_filename'])
+  image = sys.intern(os.path.splitext(scene_fn)[0])
+  image_index = int(image.split('_')[-1])
+
+  # Order templates by the number of questions we have so far for those
+  # templates. This is a simple heuristic to give a flat distribution over
+  # templates.
+  templates_items = list(templates.items())
+  templates_items = sorted(templates_items,
+                      key=lambda x: template_counts[x[0][:2]])
+  num_instantiated = 0
+  for (fn, idx), template in templates_items:
+    if args.verbose:
+      print('trying template ', fn, idx)
+    if args.time_dfs and args.verbose:
+      tic = time.time()
+    ts, qs, ans = instantiate_templates_dfs(
+                    scene_struct,
+                    template,
+                    metadata,
+                    template_answer_counts[(fn, idx)],
+                    synonyms,
+                    max_instances=args.instances_per_template,
+                    verbose=False)
+    if args.time_dfs and args.verbose:
+      toc = time.time()
+      print('that took ', toc - tic)
+    for t, q, a in zip(ts, qs, ans):
+      questions.append({
+        'split': split,
+        'image_filename': scene_fn,
+        'image_index': image_index,
+        'image': image,
+        'question': t,
+        'program': q,
+        'answer': a,
+        'template_filename': fn,
+        'question_family_index': idx,
+      })
+    if len(ts) > 0:
+      if args.verbose:
+        print('got one!')
+      num_instantiated += 1
+      template_counts[(fn, idx)] += 1
+    elif args.verbose:
+      print('did not get any =(')
+    if num_instantiated >= args.templates_per_image:
+      break
+  return questions
+
+
+# State shared with worker processes when generating with --workers. It is set
+# in the parent before the workers are forked, so the workers share the loaded
+# templates, metadata and synonyms copy-on-write rather than receiving a copy
+# with every task.
+_worker_state = {}
+
+
+def _generate_chunk(scenes, template_counts, template_answer_counts, seed):
+  """
+  Generate questions for a chunk of scenes in a worker process, starting from
+  a snapshot of the global counts. Returns a tuple (scene_questions,
+  template_count_deltas, answer_count_deltas, handler_stats) giving the
+  questions for each scene, the changes made to the counts, and the handler
+  stats recorded for the chunk (None unless --profile_handlers is given).
+  """
+  random.seed(seed)
+  state = _worker_state
+  # Stats were enabled in the parent before forking, so the copy of the
+  # registry in this process records them; start each chunk from zero
+  qeng.clevr_handlers.reset_stats()
+  old_template_counts = dict(template_counts)
+  old_answer_counts = {k: v.copy() for k, v in template_answer_counts.items()}
+  scene_questions = []
+  for scene in scenes:
+    scene_questions.append(generate_scene_questions(
+        scene, state['templates'], state['metadata'], state['synonyms'],
+        template_counts, template_answer_counts, state['scene_info'],
+        state['args']))
+
+  template_count_deltas = {}
+  for key, count in template_counts.items():
+    if count != old_template_counts[key]:
+      template_count_deltas[key] = count - old_template_counts[key]
+  answer_count_deltas = {}
+  for key, answer_counts in template_answer_counts.items():
+    old_counts = old_answer_counts[key]
+    for answer, count in answer_counts.items():
+      if count != old_counts[answer]:
+        answer_count_deltas[(key, answer)] = count - old_counts[answer]
+  handler_stats = qeng.clevr_handlers.stats
+  return (scene_questions, template_count_deltas, answer_count_deltas,
+          handler_stats)
+
+
+def generate_questions_parallel(all_scenes, num_scenes, templates, metadata,
+                                synonyms, scene_info, reset_counts, writer,
+                                args):
+  """
+  Generate questions for the scenes in the iterable all_scenes (of which there
+  are num_scenes, if known) using args.workers forked processes, passing them
+  to writer in scene order. Scenes are only read from all_scenes as
+  workers become free.
+
+  Scenes are handed out in chunks of args.scenes_per_chunk. Each chunk is
+  generated from a snapshot of the global template and answer counts. Chunks
+  are collected in whatever order they finish, and their changes to the
+  counts are merged back right away, so the balancing heuristics see every
+  finished chunk; questions are still written in scene order. Counts are
+  reset every args.reset_counts_every scenes as in serial generation; chunks
+  never cross a reset, and changes from chunks started before the latest
+  reset are dropped. So that most chunks start from counts that include
+  earlier chunks of the same period, at most half of args.reset_counts_every
+  scenes (and at most two chunks per worker) are in flight at once.
+  Every chunk is generated with its own random seed drawn from the parent's
+  random state.
+  """
+  _worker_state.update({
+    'templates': templates,
+    'metadata': metadata,
+    'synonyms': synonyms,
+    'scene_info': scene_info,
+    'args': args,
+  })
+  pool = multiprocessing.get_context('fork').Pool(args.workers)
+  max_chunks_in_flight = 2 * args.workers
+  max_scenes_in_flight = max(args.scenes_per_chunk, args.reset_counts_every // 2)
+  # Chunks in scene order; each is a dict, which gets 'questions' once the
+  # chunk has finished and been merged
+  chunks = deque()
+  # Pool callbacks run in another thread, so they only report which chunk
+  # finished and the counts are merged in this thread
+  finished = queue.Queue()
+  state = {'epoch': -1, 'chunks_in_flight': 0, 'scenes_in_flight': 0,
+           'num_finished': 0}
+
+  def merge_chunk(chunk):
+    (scene_questions, template_count_deltas, answer_count_deltas,
+     handler_stats) = chunk['result'].get()
+    if chunk['epoch'] == state['epoch']:
+      for key, delta in template_count_deltas.items():
+        state['template_counts'][key] += delta
+      for (key, answer), delta in answer_count_deltas.items():
+        state['template_answer_counts'][key].add(answer, delta)
+    if handler_stats is not None:
+      qeng.clevr_handlers.merge_stats(handler_stats)
+    chunk['questions'] = scene_questions
+    state['chunks_in_flight'] -= 1
+    state['scenes_in_flight'] -= len(chunk['scenes'])
+
+  def write_chunks():
+    while chunks and 'questions' in chunks[0]:
+      chunk = chunks.popleft()
+      for scene, qs in zip(chunk['scenes'], chunk['questions']):
+        state['num_finished'] += 1
+        print('finished image %s (%s)'
+              % (scene['image_filename'],
+                 format_progress(state['num_finished'] - 1, num_scenes)))
+        for q in qs:
+          q['template_filename'] = sys.intern(q['template_filename'])
+          writer.write(q)
+
+  def wait_for_chunks():
+    # Block until at least one chunk finishes, then merge all finished ones
+    merge_chunk(finished.get())
+    while True:
+      try:
+        chunk = finished.get_nowait()
+      except queue.Empty:
+        break
+      merge_chunk(chunk)
+    write_chunks()
+
+  try:
+    all_scenes = iter(all_scenes)
+    start = 0
+    while True:
+      next_reset = (start // args.reset_counts_every + 1) * args.reset_counts_every
+      chunk_size = min(args.scenes_per_chunk, next_reset - start)
+      scenes = list(itertools.islice(all_scenes, chunk_size))
+      if not scenes:
+        break
+      while (state['chunks_in_flight'] >= max_chunks_in_flight or
+             state['scenes_in_flight'] + len(scenes) > max_scenes_in_flight):
+        wait_for_chunks()
+      if start % args.reset_counts_every == 0:
+        print('resetting counts')
+        state['epoch'] += 1
+        state['template_counts'], state['template_answer_counts'] = reset_counts()
+      end = start + len(scenes)
+      # The pool pickles arguments in a background thread, so send copies of
+      # the counts rather than the dicts that merge_chunk updates
+      template_counts = dict(state['template_counts'])
+      template_answer_counts = {k: v.copy() for k, v in
+                                state['template_answer_counts'].items()}
+      seed = random.randint(0, 2 ** 32 - 1)
+      chunk = {'epoch': state['epoch'], 'scenes': scenes}
+      def on_finished(result, chunk=chunk):
+        finished.put(chunk)
+      chunk['result'] = pool.apply_async(
+          _generate_chunk, (scenes, template_counts, template_answer_counts,
+                            seed),
+          callback=on_finished, error_callback=on_finished)
+      chunks.append(chunk)
+      state['chunks_in_flight'] += 1
+      state['scenes_in_flight'] += len(scenes)
+      start = end
+    while chunks:
+      wait_for_chunks()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+# Arguments that must be the same when resuming from a checkpoint
+checkpoint_arg_names = [
+  'input_scene_file', 'metadata_file', 'synonyms_json', 'template_dir',
+  'output_questions_file', 'scene_start_idx', 'num_scenes',
+  'templates_per_image', 'instances_per_template', 'reset_counts_every',
+]
+
+
+def save_checkpoint(filename, checkpoint):
+  """
+  Write a checkpoint atomically, so that an interrupted write leaves the
+  previous checkpoint in place.
+  """
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'wb') as f:
+    pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename, args):
+  """
+  Load a checkpoint written by save_checkpoint, checking that it was written
+  by a run with the same arguments. Returns None if there is no checkpoint.
+  """
+  if not os.path.isfile(filename):
+    return None
+  with open(filename, 'rb') as f:
+    checkpoint = pickle.load(f)
+  for name in checkpoint_arg_names:
+    if checkpoint['args'][name] != getattr(args, name):
+      raise ValueError('Cannot resume: --%s was %r but is now %r'
+                       % (name, checkpoint['args'][name], getattr(args, name)))
+  return checkpoint
+
+
 def main(args):
   with open(args.metadata_file, 'r') as f:
     metadata = json.load(f)
@@ -543,29 +1117,30 @@ def main(args):
 
   # Load templates from disk
   # Key is (filename, file_idx)
-  num_loaded_templates = 0
-  templates = {}
-  for fn in os.listdir(args.template_dir):
-    if not fn.endswith('.json'): continue
-    with open(os.path.join(args.template_dir, fn), 'r') as f:
-      base = os.path.splitext(fn)[0]
-      for i, template in enumerate(json.load(f)):
-        num_loaded_templates += 1
-        key = (fn, i)
-        templates[key] = template
-  print('Read %d templates from disk' % num_loaded_templates)
+  template_cache_file = None
+  if not args.no_template_cache:
+    template_cache_file = args.template_cache_file
+    if template_cache_file is None:
+      template_cache_file = template_compiler.get_default_cache_file(
+          args.template_dir)
+  templates = template_compiler.load_templates(args.template_dir, metadata,
+                                               template_cache_file)
+  print('Read %d templates from disk' % len(templates))
+
+  if args.profile_handlers:
+    qeng.clevr_handlers.enable_stats()
 
   def reset_counts():
     # Maps a template (filename, index) to the number of questions we have
     # so far using that template
     template_counts = {}
-    # Maps a template (filename, index) to a dict mapping the answer to the
-    # number of questions so far of that template type with that answer
+    # Maps a template (filename, index) to an AnswerCounter giving the
+    # number of questions so far of that template type with each answer
     template_answer_counts = {}
     node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
     for key, template in templates.items():
       template_counts[key[:2]] = 0
-      final_node_type = template['nodes'][-1]['type']
+      final_node_type = template.nodes[-1]['type']
       final_dtype = node_type_to_dtype[final_node_type]
       answers = metadata['types'][final_dtype]
       if final_dtype == 'Bool':
@@ -573,116 +1148,96 @@ def main(args):
       if final_dtype == 'Integer':
         if metadata['dataset'] == 'CLEVR-v1.0':
           answers = list(range(0, 11))
-      template_answer_counts[key[:2]] = {}
-      for a in answers:
-        template_answer_counts[key[:2]][a] = 0
+      template_answer_counts[key[:2]] = AnswerCounter(answers)
     return template_counts, template_answer_counts
 
   template_counts, template_answer_counts = reset_counts()
 
-  # Read file containing input scenes
-  all_scenes = []
-  with open(args.input_scene_file, 'r') as f:
-    scene_data = json.load(f)
-    all_scenes = scene_data['scenes']
-    scene_info = scene_data['info']
-  begin = args.scene_start_idx
+  checkpoint_file = args.checkpoint_file
+  if checkpoint_file is None:
+    checkpoint_file = args.output_questions_file + '.checkpoint'
+  checkpoint = None
+  if args.workers > 0 and (args.resume or args.checkpoint_every > 0):
+    raise ValueError('Checkpoints are not supported with --workers')
+  if args.resume:
+    checkpoint = load_checkpoint(checkpoint_file, args)
+  if checkpoint is not None and checkpoint['finished']:
+    print('Checkpoint %s says this run has already finished' % checkpoint_file)
+    return
+  num_scenes_done = 0
+  if checkpoint is not None:
+    num_scenes_done = checkpoint['num_scenes_done']
+    template_counts = checkpoint['template_counts']
+    template_answer_counts = checkpoint['template_answer_counts']
+    random.setstate(checkpoint['random_state'])
+    print('Resuming from %s after %d scenes' % (checkpoint_file, num_scenes_done))
+
+  # Open the input scenes; they are read one at a time as they are needed
+  num_scenes_left = args.num_scenes
   if args.num_scenes > 0:
-    end = args.scene_start_idx + args.num_scenes
-    all_scenes = all_scenes[begin:end]
-  else:
-    all_scenes = all_scenes[begin:]
+    num_scenes_left = args.num_scenes - num_scenes_done
+  scene_info, all_scenes, num_scenes = json_stream.load_scenes(
+      args.input_scene_file, args.scene_start_idx + num_scenes_done,
+      num_scenes_left)
+  if args.num_scenes > 0 and num_scenes_left <= 0:
+    all_scenes = iter([])
+  if num_scenes is not None:
+    num_scenes += num_scenes_done
 
   # Read synonyms file
   with open(args.synonyms_json, 'r') as f:
     synonyms = json.load(f)
 
-  questions = []
-  scene_count = 0
-  for i, scene in enumerate(all_scenes):
-    scene_fn = scene['image_filename']
-    scene_struct = scene
-    print('starting image %s (%d / %d)'
-          % (scene_fn, i + 1, len(all_scenes)))
-
-    if scene_count % args.reset_counts_every == 0:
-      print('resetting counts')
-      template_counts, template_answer_counts = reset_counts()
-    scene_count += 1
-
-    # Order templates by the number of questions we have so far for those
-    # templates. This is a simple heuristic to give a flat distribution over
-    # templates.
-    templates_items = list(templates.items())
-    templates_items = sorted(templates_items,
-                        key=lambda x: template_counts[x[0][:2]])
-    num_instantiated = 0
-    for (fn, idx), template in templates_items:
-      if args.verbose:
-        print('trying template ', fn, idx)
-      if args.time_dfs and args.verbose:
-        tic = time.time()
-      ts, qs, ans = instantiate_templates_dfs(
-                      scene_struct,
-                      template,
-                      metadata,
-                      template_answer_counts[(fn, idx)],
-                      synonyms,
-                      max_instances=args.instances_per_template,
-                      verbose=False)
-      if args.time_dfs and args.verbose:
-        toc = time.time()
-        print('that took ', toc - tic)
-      image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
-      for t, q, a in zip(ts, qs, ans):
-        questions.append({
-          'split': scene_info['split'],
-          'image_filename': scene_fn,
-          'image_index': image_index,
-          'image': os.path.splitext(scene_fn)[0],
-          'question': t,
-          'program': q,
-          'answer': a,
-          'template_filename': fn,
-          'question_family_index': idx,
-          'question_index': len(questions),
-        })
-      if len(ts) > 0:
-        if args.verbose:
-          print('got one!')
-        num_instantiated += 1
-        template_counts[(fn, idx)] += 1
-      elif args.verbose:
-        print('did not get any =(')
-      if num_instantiated >= args.templates_per_image:
-        break
+  print('Writing output to %s' % args.output_questions_file)
+  writer = QuestionWriter(args.output_questions_file, scene_info,
+      resume_state=checkpoint['writer'] if checkpoint is not None else None)
+
+  def make_checkpoint(finished=False):
+    # Once the run has finished the writer is closed, and there is nothing
+    # left to resume
+    return {
+      'args': {name: getattr(args, name) for name in checkpoint_arg_names},
+      'num_scenes_done': num_scenes_done,
+      'template_counts': template_counts,
+      'template_answer_counts': template_answer_counts,
+      'random_state': random.getstate(),
+      'writer': None if finished else writer.get_state(),
+      'finished': finished,
+    }
 
-  # Change "side_inputs" to "value_inputs" in all functions of all functional
-  # programs. My original name for these was "side_inputs" but I decided to
-  # change the name to "value_inputs" for the public CLEVR release. I should
-  # probably go through all question generation code and templates and rename,
-  # but that could be tricky and take a while, so instead I'll just do it here.
-  # To further complicate things, originally functions without value inputs did
-  # not have a "side_inputs" field at all, and I'm pretty sure this fact is used
-  # in some of the code above; however in the public CLEVR release all functions
-  # have a "value_inputs" field, and it's an empty list for functions that take
-  # no value inputs. Again this should probably be refactored, but the quick and
-  # dirty solution is to keep the code above as-is, but here make "value_inputs"
-  # an empty list for those functions that do not have "side_inputs". Gross.
-  for q in questions:
-    for f in q['program']:
-      if 'side_inputs' in f:
-        f['value_inputs'] = f['side_inputs']
-        del f['side_inputs']
-      else:
-        f['value_inputs'] = []
-
-  with open(args.output_questions_file, 'w') as f:
-    print('Writing output to %s' % args.output_questions_file)
-    json.dump({
-        'info': scene_info,
-        'questions': questions,
-      }, f)
+  if args.workers > 0:
+    generate_questions_parallel(all_scenes, num_scenes, templates, metadata,
+                                synonyms, scene_info, reset_counts, writer,
+                                args)
+  else:
+    scene_count = num_scenes_done
+    for i, scene in enumerate(all_scenes, num_scenes_done):
+      scene_fn = scene['image_filename']
+      print('starting image %s (%s)'
+            % (scene_fn, format_progress(i, num_scenes)))
+
+      if scene_count % args.reset_counts_every == 0:
+        print('resetting counts')
+        template_counts, template_answer_counts = reset_counts()
+      scene_count += 1
+
+      for q in generate_scene_questions(scene, templates, metadata, synonyms,
+                                        template_counts, template_answer_counts,
+                                        scene_info, args):
+        writer.write(q)
+      num_scenes_done += 1
+      if (args.checkpoint_every > 0 and
+          num_scenes_done % args.checkpoint_every == 0):
+        save_checkpoint(checkpoint_file, make_checkpoint())
+  # Only record that the run has finished once the output is complete
+  writer.close(sync=args.checkpoint_every > 0)
+  if args.checkpoint_every > 0:
+    save_checkpoint(checkpoint_file, make_checkpoint(finished=True))
+  print('Wrote %d questions' % writer.num_questions)
+
+  if args.profile_handlers:
+    print(qeng.clevr_handlers.format_stats())
+    qeng.clevr_handlers.disable_stats()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,254 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import itertools, json, os
+
+"""
+Utilities for reading large JSON files incrementally.
+
+Scene and question files are single JSON objects of the form
+{"info": {...}, "scenes": [...]} (or "questions": [...]); for large datasets
+loading them with json.load takes a long time and a lot of memory. The
+functions here parse such files a piece at a time, yielding the elements of
+one of the top-level arrays as they are read, so only one element needs to be
+in memory at once. This only uses the json module from the standard library.
+
+load_scenes opens scenes in any of the formats accepted by the scripts in
+this directory: combined scene files, JSON Lines, or directories of
+per-scene files.
+"""
+
+
+_whitespace = ' \t\n\r'
+_delimiters = _whitespace + ',:]}'
+
+
+class JSONStreamReader(object):
+  """
+  Reads JSON values one at a time from a file, buffering as needed.
+  """
+  def __init__(self, f, chunk_size=2 ** 16):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _read_more(self, min_size=0):
+    if self.eof:
+      return False
+    # Drop the consumed part of the buffer and read at least as much as we
+    # already have, so that reading a large value takes linear time
+    self.buf = self.buf[self.pos:]
+    self.pos = 0
+    chunk = self.f.read(max(self.chunk_size, min_size))
+    if not chunk:
+      self.eof = True
+      return False
+    self.buf += chunk
+    return True
+
+  def peek(self):
+    """
+    Skip whitespace and return the next character, or None at end of file.
+    """
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._read_more():
+        return None
+
+  def expect(self, c):
+    if self.peek() != c:
+      raise ValueError('Expected "%s" at offset %d of buffer' % (c, self.pos))
+    self.pos += 1
+
+  def read_value(self):
+    """
+    Parse and return the next JSON value.
+    """
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+      except ValueError:
+        value, end = None, None
+      # A value may be truncated by the end of the buffer and still parse (for
+      # example "3.5" read as "3."), so only accept it if it is followed by a
+      # delimiter or the file is exhausted.
+      if end is not None and (self.eof or
+          (end < len(self.buf) and self.buf[end] in _delimiters)):
+        self.pos = end
+        return value
+      if not self._read_more(len(self.buf) - self.pos):
+        if end is not None:
+          self.pos = end
+          return value
+        raise ValueError('Could not parse JSON value at end of file')
+
+
+
+def iter_object_items(f, chunk_size=2 ** 16):
+  """
+  Iterate over the top-level object in the file f, yielding tuples
+  (key, reader) where reader is a JSONStreamReader positioned at the start of
+  the value for key. The caller must consume the value (for example with
+  reader.read_value() or iter_array_values(reader)) before asking for the
+  next item; values that are not consumed are parsed and discarded.
+  """
+  reader = JSONStreamReader(f, chunk_size=chunk_size)
+  reader.expect('{')
+  if reader.peek() == '}':
+    return
+  while True:
+    key = reader.read_value()
+    reader.expect(':')
+    start_buf, start_pos = reader.buf, reader.pos
+    yield key, reader
+    if reader.buf is start_buf and reader.pos == start_pos:
+      reader.read_value()
+    c = reader.peek()
+    reader.pos += 1
+    if c == '}':
+      return
+    if c != ',':
+      raise ValueError('Expected "," or "}" in top-level object')
+
+
+def iter_array_values(reader, start=0, stop=None):
+  """
+  Yield the elements of the JSON array at the current position of reader,
+  optionally only those with indices in [start, stop). Elements before start
+  are still parsed (the json module does this much faster than we could skip
+  over them in Python), but are discarded immediately.
+  """
+  reader.expect('[')
+  if reader.peek() == ']':
+    reader.pos += 1
+    return
+  idx = 0
+  while True:
+    if stop is not None and idx >= stop:
+      return
+    value = reader.read_value()
+    if idx >= start:
+      yield value
+    idx += 1
+    c = reader.peek()
+    reader.pos += 1
+    if c == ']':
+      return
+    if c != ',':
+      raise ValueError('Expected "," or "]" in array')
+
+
+def iter_json_array(filename, key, start=0, stop=None, chunk_size=2 ** 16):
+  """
+  Yield the elements of the array stored under key in the top-level object of
+  the JSON file filename, one at a time; if start or stop are given then only
+  elements with indices in [start, stop) are yielded. Raises a KeyError if
+  there is no such key.
+  """
+  with open(filename, 'r') as f:
+    for k, reader in iter_object_items(f, chunk_size=chunk_size):
+      if k == key:
+        for value in iter_array_values(reader, start, stop):
+          yield value
+        return
+  raise KeyError('No key "%s" in %s' % (key, filename))
+
+
+def load_json_info(filename, key='info'):
+  """
+  Return the value stored under key in the top-level object of the JSON file
+  filename, stopping as soon as it has been read; returns None if there is
+  no such key. Other values that appear before it are parsed and discarded.
+  """
+  with open(filename, 'r') as f:
+    for k, reader in iter_object_items(f):
+      if k == key:
+        return reader.read_value()
+  return None
+
+
+def iter_jsonl(filename, start=0, stop=None):
+  """
+  Yield the values in a JSON Lines file (one JSON value per line, blank lines
+  ignored), optionally only those with indices in [start, stop); lines before
+  start are not parsed.
+  """
+  idx = 0
+  with open(filename, 'r') as f:
+    for line in f:
+      if not line.strip():
+        continue
+      if stop is not None and idx >= stop:
+        return
+      if idx >= start:
+        yield json.loads(line)
+      idx += 1
+
+
+def load_scenes(input_scene_file, start_idx=0, num_scenes=0):
+  """
+  Open the input scenes for streaming. input_scene_file may be a combined JSON
+  file as written by collect_scenes.py, a JSON Lines file with one scene per
+  line (optionally preceded by a line {"info": ...}), or a directory of
+  per-scene JSON files, which are read in order of filename (optionally with
+  the scene info in a file info.json). Scenes before start_idx are skipped,
+  and at most num_scenes scenes are read if num_scenes is positive. If the
+  scene info is not given, it only has the split of the first scene.
+
+  Returns a tuple (scene_info, scenes, total) where scenes is an iterator over
+  the selected scenes and total is the number of selected scenes if it is
+  known without reading them all, and None otherwise.
+  """
+  stop = start_idx + num_scenes if num_scenes > 0 else None
+  if os.path.isdir(input_scene_file):
+    filenames = sorted(fn for fn in os.listdir(input_scene_file)
+                       if fn.endswith('.json') and fn != 'info.json')
+    filenames = filenames[start_idx:stop]
+    scene_info = {}
+    info_file = os.path.join(input_scene_file, 'info.json')
+    if os.path.isfile(info_file):
+      with open(info_file, 'r') as f:
+        scene_info = json.load(f)
+    def iter_scene_files():
+      for fn in filenames:
+        with open(os.path.join(input_scene_file, fn), 'r') as f:
+          yield json.load(f)
+    scenes = iter_scene_files()
+    first_scene = next(scenes, None)
+    if first_scene is None:
+      return scene_info, iter([]), 0
+    scene_info.setdefault('split', first_scene['split'])
+    return scene_info, itertools.chain([first_scene], scenes), len(filenames)
+
+  if input_scene_file.endswith('.jsonl'):
+    scene_info = {}
+    with open(input_scene_file, 'r') as f:
+      first_line = f.readline()
+    first = json.loads(first_line) if first_line.strip() else {}
+    has_info = 'info' in first and 'objects' not in first
+    if has_info:
+      scene_info = first['info']
+      start_idx, stop = start_idx + 1, None if stop is None else stop + 1
+    scenes = iter_jsonl(input_scene_file, start_idx, stop)
+    if not has_info:
+      first_scene = next(scenes, None)
+      if first_scene is None:
+        return {}, iter([]), 0
+      scene_info = {'split': first_scene['split']}
+      scenes = itertools.chain([first_scene], scenes)
+    return scene_info, scenes, None
+
+  scene_info = load_json_info(input_scene_file)
+  scenes = iter_json_array(input_scene_file, 'scenes', start_idx, stop)
+  return scene_info, scenes, None
@@ -5,8 +5,8 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
-import json, os, math
-from collections import defaultdict
+import json, os, math, itertools, time
+from collections import defaultdict, OrderedDict
 
 """
 Utilities for working with function program representations of questions.
@@ -16,12 +16,338 @@ in a JSON metadata file.
 """
 
 
+# Helpers for representing an ObjectSet as a single integer whose bit i is set
+# iff object i is in the set.
+
+
+def list_to_mask(object_idxs):
+  mask = 0
+  for idx in object_idxs:
+    mask |= 1 << idx
+  return mask
+
+
+def mask_to_list(mask):
+  object_idxs = []
+  while mask:
+    low_bit = mask & -mask
+    object_idxs.append(low_bit.bit_length() - 1)
+    mask ^= low_bit
+  return object_idxs
+
+
+def popcount(mask):
+  return bin(mask).count('1')
+
+
+class SceneIndex(object):
+  """
+  Columnar index over the object attributes of a single scene.
+
+  For each attribute we intern the distinct values that occur in the scene as
+  small integer codes and store one column of codes with one entry per object,
+  together with a map from each value to a bitmask of the objects that match it
+  when filtering. Attributes whose value is a list (such as the multi-label
+  attributes of some non-CLEVR datasets) are multi-valued: an object matches
+  each element of its list, its column entry is the code of the whole tuple, and
+  querying it is only valid if the list has exactly one element.
+
+  The index also groups objects by the (whole) value of each attribute, giving
+  for each value code a bitmask of the objects that have that value; this is
+  used to answer same_* nodes without comparing every pair of objects.
+
+  For CLEVR-style scenes, where scene_struct['relationships'][relation][i]
+  lists the objects that have the relation with object i, the index also
+  stores each relation as a matrix with one bitmask row per object. For
+  Visual Genome-style scenes, where scene_struct['relationships'] is a list of
+  (subject_idx, predicate, object_idx) records, it instead indexes the records
+  by (predicate, subject).
+
+  Columns are built lazily the first time an attribute is touched; use
+  get_scene_index to get the (cached) index for a scene. The index is stored
+  in the scene, but copying or pickling it gives an empty index over the
+  copied objects, so a deep copy of a scene can be modified and answered
+  without seeing the original's index; after modifying a scene in place,
+  call invalidate_scene.
+  """
+  def __init__(self, scene_struct):
+    self.objects = scene_struct['objects']
+    self.relationships = scene_struct.get('relationships')
+    self.num_objects = len(self.objects)
+    self.all_mask = (1 << self.num_objects) - 1
+    self.codes = {}
+    self.values = {}
+    self.columns = {}
+    self.value_masks = {}
+    self.group_masks = {}
+    self.query_values = {}
+    self.relate_masks = {}
+    self.filter_masks = {}
+    self.vg_related = None
+
+  def __reduce__(self):
+    # Copies start out empty; copy.deepcopy copies the objects through its
+    # memo, so the copy indexes the objects of the copied scene
+    scene_struct = {
+      'objects': self.objects,
+      'relationships': self.relationships,
+    }
+    return (SceneIndex, (scene_struct,))
+
+  def _build_column(self, attribute):
+    codes, values, column = {}, [], []
+    value_masks, group_masks, query_values = {}, [], []
+    for idx, obj in enumerate(self.objects):
+      val = obj[attribute]
+      if type(val) == list:
+        key = tuple(val)
+        members = val
+        query_values.append(val[0] if len(val) == 1 else '__INVALID__')
+      else:
+        key = val
+        members = [val]
+        query_values.append(val)
+      if key not in codes:
+        codes[key] = len(values)
+        values.append(key)
+        group_masks.append(0)
+      column.append(codes[key])
+      group_masks[codes[key]] |= 1 << idx
+      for member in members:
+        value_masks[member] = value_masks.get(member, 0) | (1 << idx)
+    self.codes[attribute] = codes
+    self.values[attribute] = values
+    self.columns[attribute] = column
+    self.value_masks[attribute] = value_masks
+    self.group_masks[attribute] = group_masks
+    self.query_values[attribute] = query_values
+
+  def get_value_mask(self, attribute, value):
+    """
+    Return a bitmask of the objects whose attribute matches value.
+    """
+    if attribute not in self.value_masks:
+      self._build_column(attribute)
+    return self.value_masks[attribute].get(value, 0)
+
+  def get_filter_mask(self, attribute_values):
+    """
+    Return a bitmask of the objects that match all of the given attribute
+    values, which are given as a flat list [attribute_1, value_1, attribute_2,
+    value_2, ...] (the value inputs of a filter_fused node). The tests are
+    applied in order of their selectivity on this scene, most selective
+    first, so that the mask becomes empty as early as possible; the order is
+    worked out once per list of attribute values.
+    """
+    key = tuple(attribute_values)
+    masks = self.filter_masks.get(key)
+    if masks is None:
+      masks = [self.get_value_mask(attribute_values[k], attribute_values[k + 1])
+               for k in range(0, len(attribute_values), 2)]
+      masks.sort(key=popcount)
+      self.filter_masks[key] = masks
+    mask = self.all_mask
+    for value_mask in masks:
+      mask &= value_mask
+      if mask == 0:
+        break
+    return mask
+
+  def get_same_mask(self, attribute, idx):
+    """
+    Return a bitmask of the objects other than object idx that have the same
+    value for the attribute as object idx.
+    """
+    if attribute not in self.group_masks:
+      self._build_column(attribute)
+    code = self.columns[attribute][idx]
+    return self.group_masks[attribute][code] & ~(1 << idx)
+
+  def get_relate_mask(self, relation, idx):
+    """
+    Return a bitmask of the objects that have the relation with object idx.
+    """
+    if relation not in self.relate_masks:
+      related = self.relationships[relation]
+      self.relate_masks[relation] = [list_to_mask(r) for r in related]
+    return self.relate_masks[relation][idx]
+
+  def get_vg_related(self, predicate, subject_idx):
+    """
+    Return a sorted list of the objects that are the object of a Visual
+    Genome-style relationship with the given predicate and subject.
+    """
+    if self.vg_related is None:
+      vg_related = {}
+      for rel in self.relationships:
+        key = (rel['predicate'], rel['subject_idx'])
+        if key not in vg_related:
+          vg_related[key] = set()
+        vg_related[key].add(rel['object_idx'])
+      self.vg_related = {k: sorted(v) for k, v in vg_related.items()}
+    return self.vg_related.get((predicate, subject_idx), [])
+
+  def get_query_value(self, attribute, idx):
+    """
+    Return the value of the attribute of object idx as seen by query nodes.
+    """
+    if attribute not in self.query_values:
+      self._build_column(attribute)
+    return self.query_values[attribute][idx]
+
+
+def get_scene_index(scene_struct):
+  if '_index' not in scene_struct:
+    scene_struct['_index'] = SceneIndex(scene_struct)
+  return scene_struct['_index']
+
+
+def invalidate_scene(scene_struct):
+  """
+  Drop everything cached in a scene, such as its SceneIndex and its key in
+  node_output_cache, so that questions answered on it after it has been
+  modified in place see the modifications. By convention all such data is
+  stored under keys starting with an underscore, including the caches added
+  by question generation.
+  """
+  for key in list(scene_struct.keys()):
+    if key.startswith('_'):
+      del scene_struct[key]
+
+
+class HandlerRegistry(object):
+  """
+  A named set of handlers for executing programs, keyed by node type.
+
+  Handlers are added with the register decorator, or with add for handlers
+  built by factory functions. Several registries can coexist, so the same
+  engine can execute programs over different sets of node types (CLEVR,
+  Visual Genome, or custom ones) by passing a registry to answer_question.
+  If bitmask is True then the handlers represent ObjectSets as bitmasks.
+  Registry names are part of the keys used by node_output_cache, so they
+  should be unique.
+
+  The engine reads handlers from the plain dict self.handlers. enable_stats
+  replaces each handler in that dict with a wrapper that records, per node
+  type, the number of calls, the total time spent in the handler, and the
+  total size of its outputs (the number of objects, for ObjectSets);
+  disable_stats puts the original handlers back, so a registry without stats
+  enabled costs nothing extra.
+  """
+  def __init__(self, name, bitmask=False):
+    self.name = name
+    self.bitmask = bitmask
+    self.handlers = {}
+    self.raw_handlers = {}
+    self.stats = None
+
+  def add(self, node_type, handler):
+    self.raw_handlers[node_type] = handler
+    if self.stats is None:
+      self.handlers[node_type] = handler
+    else:
+      self.handlers[node_type] = self._instrument(node_type, handler)
+
+  def register(self, *node_types):
+    """
+    Decorator registering a handler for each of the given node types.
+    """
+    def decorator(handler):
+      for node_type in node_types:
+        self.add(node_type, handler)
+      return handler
+    return decorator
+
+  def copy(self, name, bitmask=None):
+    """
+    Return a new registry with the same (uninstrumented) handlers.
+    """
+    if bitmask is None:
+      bitmask = self.bitmask
+    registry = HandlerRegistry(name, bitmask=bitmask)
+    for node_type, handler in self.raw_handlers.items():
+      registry.add(node_type, handler)
+    return registry
+
+  def __contains__(self, node_type):
+    return node_type in self.handlers
+
+  def __getitem__(self, node_type):
+    return self.handlers[node_type]
+
+  def enable_stats(self):
+    if self.stats is None:
+      self.stats = {}
+      for node_type, handler in self.raw_handlers.items():
+        self.handlers[node_type] = self._instrument(node_type, handler)
+
+  def disable_stats(self):
+    self.stats = None
+    self.handlers.update(self.raw_handlers)
+
+  def reset_stats(self):
+    if self.stats is not None:
+      self.stats.clear()
+
+  def merge_stats(self, stats):
+    """
+    Add stats recorded elsewhere (such as a copy of the registry in a worker
+    process) to the stats of this registry, which must have stats enabled.
+    """
+    assert self.stats is not None, 'Stats are not enabled'
+    for node_type, (calls, total_time, total_size) in stats.items():
+      node_stats = self.stats.get(node_type)
+      if node_stats is None:
+        node_stats = self.stats[node_type] = [0, 0.0, 0]
+      node_stats[0] += calls
+      node_stats[1] += total_time
+      node_stats[2] += total_size
+
+  def _instrument(self, node_type, handler):
+    stats = self.stats
+    count_bits = self.bitmask and node_type in object_set_node_types
+    timer = time.perf_counter
+    def instrumented_handler(scene_struct, inputs, side_inputs):
+      start = timer()
+      output = handler(scene_struct, inputs, side_inputs)
+      elapsed = timer() - start
+      node_stats = stats.get(node_type)
+      if node_stats is None:
+        node_stats = stats[node_type] = [0, 0.0, 0]
+      node_stats[0] += 1
+      node_stats[1] += elapsed
+      if type(output) is list:
+        node_stats[2] += len(output)
+      elif count_bits and output != '__INVALID__':
+        node_stats[2] += popcount(output)
+      return output
+    return instrumented_handler
+
+  def format_stats(self):
+    """
+    Return a table of the recorded stats, slowest node types first. The
+    table is empty if stats are not enabled.
+    """
+    lines = ['%-24s %10s %10s %10s %10s' % (
+             'node type', 'calls', 'time (s)', 'us / call', 'avg size')]
+    stats = sorted((self.stats or {}).items(), key=lambda x: -x[1][1])
+    for node_type, (calls, total_time, total_size) in stats:
+      lines.append('%-24s %10d %10.3f %10.2f %10.2f' % (
+                   node_type, calls, total_time, 1e6 * total_time / calls,
+                   total_size / float(calls)))
+    return '\n'.join(lines)
+
+
 # Handlers for answering questions. Each handler receives the scene structure
 # that was output from Blender, the node, and a list of values that were output
 # from each of the node's inputs; the handler should return the computed output
-# value from this node.
+# value from this node. Handlers are registered for CLEVR node types in
+# clevr_handlers; see below for registries using other sets of node types.
+
+clevr_handlers = HandlerRegistry('clevr')
 
 
+@clevr_handlers.register('scene')
 def scene_handler(scene_struct, inputs, side_inputs):
   # Just return all objects in the scene
   return list(range(len(scene_struct['objects'])))
@@ -31,16 +357,24 @@ def make_filter_handler(attribute):
   def filter_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 1
-    value = side_inputs[0]
-    output = []
-    for idx in inputs[0]:
-      atr = scene_struct['objects'][idx][attribute]
-      if value == atr or value in atr:
-        output.append(idx)
-    return output
+    index = get_scene_index(scene_struct)
+    mask = index.get_value_mask(attribute, side_inputs[0])
+    return [idx for idx in inputs[0] if (mask >> idx) & 1]
+  filter_handler.filter_attribute = attribute
   return filter_handler
 
 
+@clevr_handlers.register('filter_fused')
+def filter_fused_handler(scene_struct, inputs, side_inputs):
+  # A chain of filters fused by optimize_program
+  assert len(inputs) == 1
+  assert len(side_inputs) % 2 == 0
+  index = get_scene_index(scene_struct)
+  mask = index.get_filter_mask(side_inputs)
+  return [idx for idx in inputs[0] if (mask >> idx) & 1]
+
+
+@clevr_handlers.register('unique')
 def unique_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 1
   if len(inputs[0]) != 1:
@@ -51,14 +385,12 @@ def unique_handler(scene_struct, inputs, side_inputs):
 def vg_relate_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 1
-  output = set()
-  for rel in scene_struct['relationships']:
-    if rel['predicate'] == side_inputs[0] and rel['subject_idx'] == inputs[0]:
-      output.add(rel['object_idx'])
-  return sorted(list(output))
+  index = get_scene_index(scene_struct)
+  return index.get_vg_related(side_inputs[0], inputs[0])
 
 
 
+@clevr_handlers.register('relate')
 def relate_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 1
@@ -66,18 +398,21 @@ def relate_handler(scene_struct, inputs, side_inputs):
   return scene_struct['relationships'][relation][inputs[0]]
     
 
+@clevr_handlers.register('union')
 def union_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return sorted(list(set(inputs[0]) | set(inputs[1])))
 
 
+@clevr_handlers.register('intersect')
 def intersect_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return sorted(list(set(inputs[0]) & set(inputs[1])))
 
 
+@clevr_handlers.register('count')
 def count_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 1
   return len(inputs[0])
@@ -85,21 +420,10 @@ def count_handler(scene_struct, inputs, side_inputs):
 
 def make_same_attr_handler(attribute):
   def same_attr_handler(scene_struct, inputs, side_inputs):
-    cache_key = '_same_%s' % attribute
-    if cache_key not in scene_struct:
-      cache = {}
-      for i, obj1 in enumerate(scene_struct['objects']):
-        same = []
-        for j, obj2 in enumerate(scene_struct['objects']):
-          if i != j and obj1[attribute] == obj2[attribute]:
-            same.append(j)
-        cache[i] = same
-      scene_struct[cache_key] = cache
-
-    cache = scene_struct[cache_key]
     assert len(inputs) == 1
     assert len(side_inputs) == 0
-    return cache[inputs[0]]
+    index = get_scene_index(scene_struct)
+    return mask_to_list(index.get_same_mask(attribute, inputs[0]))
   return same_attr_handler
 
 
@@ -107,108 +431,452 @@ def make_query_handler(attribute):
   def query_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 0
-    idx = inputs[0]
-    obj = scene_struct['objects'][idx]
-    assert attribute in obj
-    val = obj[attribute]
-    if type(val) == list and len(val) != 1:
-      return '__INVALID__'
-    elif type(val) == list and len(val) == 1:
-      return val[0]
-    else:
-      return val
+    index = get_scene_index(scene_struct)
+    return index.get_query_value(attribute, inputs[0])
   return query_handler
 
 
+@clevr_handlers.register('exist')
 def exist_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 0
   return len(inputs[0]) > 0
 
 
+@clevr_handlers.register('equal_color', 'equal_shape', 'equal_integer',
+                         'equal_material', 'equal_size', 'equal_object')
 def equal_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] == inputs[1]
 
 
+@clevr_handlers.register('less_than')
 def less_than_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] < inputs[1]
 
 
+@clevr_handlers.register('greater_than')
 def greater_than_handler(scene_struct, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] > inputs[1]
 
 
-# Register all of the answering handlers here.
-# TODO maybe this would be cleaner with a function decorator that takes
-# care of registration? Not sure. Also what if we want to reuse the same engine
-# for different sets of node types?
-execute_handlers = {
-  'scene': scene_handler,
-  'filter_color': make_filter_handler('color'),
-  'filter_shape': make_filter_handler('shape'),
-  'filter_material': make_filter_handler('material'),
-  'filter_size': make_filter_handler('size'),
-  'filter_objectcategory': make_filter_handler('objectcategory'),
-  'unique': unique_handler,
-  'relate': relate_handler,
-  'union': union_handler,
-  'intersect': intersect_handler,
-  'count': count_handler,
-  'query_color': make_query_handler('color'),
-  'query_shape': make_query_handler('shape'),
-  'query_material': make_query_handler('material'),
-  'query_size': make_query_handler('size'),
-  'exist': exist_handler,
-  'equal_color': equal_handler,
-  'equal_shape': equal_handler,
-  'equal_integer': equal_handler,
-  'equal_material': equal_handler,
-  'equal_size': equal_handler,
-  'equal_object': equal_handler,
-  'less_than': less_than_handler,
-  'greater_than': greater_than_handler,
-  'same_color': make_same_attr_handler('color'),
-  'same_shape': make_same_attr_handler('shape'),
-  'same_size': make_same_attr_handler('size'),
-  'same_material': make_same_attr_handler('material'),
+for attribute in ['color', 'shape', 'material', 'size', 'objectcategory']:
+  clevr_handlers.add('filter_' + attribute, make_filter_handler(attribute))
+for attribute in ['color', 'shape', 'material', 'size']:
+  clevr_handlers.add('query_' + attribute, make_query_handler(attribute))
+  clevr_handlers.add('same_' + attribute, make_same_attr_handler(attribute))
+
+# The handler dict read by the engine; it stays in sync with clevr_handlers
+execute_handlers = clevr_handlers.handlers
+
+
+# Bitmask handlers. These mirror the handlers above, but represent an ObjectSet
+# as a single integer whose bit i is set iff object i is in the set; this turns
+# filtering, set operations, counting, and existence tests into a handful of
+# integer operations. Objects, integers, booleans, and attribute values are
+# represented the same way as above, so only ObjectSet outputs need to be
+# converted when leaving the engine.
+
+clevr_bitmask_handlers = clevr_handlers.copy('clevr_bitmask', bitmask=True)
+
+
+@clevr_bitmask_handlers.register('scene')
+def scene_bitmask_handler(scene_struct, inputs, side_inputs):
+  return get_scene_index(scene_struct).all_mask
+
+
+def make_filter_bitmask_handler(attribute):
+  def filter_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 1
+    index = get_scene_index(scene_struct)
+    return inputs[0] & index.get_value_mask(attribute, side_inputs[0])
+  filter_handler.filter_attribute = attribute
+  return filter_handler
+
+
+@clevr_bitmask_handlers.register('filter_fused')
+def filter_fused_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) % 2 == 0
+  index = get_scene_index(scene_struct)
+  return inputs[0] & index.get_filter_mask(side_inputs)
+
+
+@clevr_bitmask_handlers.register('unique')
+def unique_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  mask = inputs[0]
+  if mask == 0 or mask & (mask - 1) != 0:
+    return '__INVALID__'
+  return mask.bit_length() - 1
+
+
+@clevr_bitmask_handlers.register('relate')
+def relate_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) == 1
+  relation = side_inputs[0]
+  return get_scene_index(scene_struct).get_relate_mask(relation, inputs[0])
+
+
+def vg_relate_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) == 1
+  index = get_scene_index(scene_struct)
+  return list_to_mask(index.get_vg_related(side_inputs[0], inputs[0]))
+
+
+@clevr_bitmask_handlers.register('union')
+def union_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 2
+  assert len(side_inputs) == 0
+  return inputs[0] | inputs[1]
+
+
+@clevr_bitmask_handlers.register('intersect')
+def intersect_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 2
+  assert len(side_inputs) == 0
+  return inputs[0] & inputs[1]
+
+
+@clevr_bitmask_handlers.register('count')
+def count_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  return popcount(inputs[0])
+
+
+@clevr_bitmask_handlers.register('exist')
+def exist_bitmask_handler(scene_struct, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) == 0
+  return inputs[0] != 0
+
+
+def make_same_attr_bitmask_handler(attribute):
+  def same_attr_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 0
+    index = get_scene_index(scene_struct)
+    return index.get_same_mask(attribute, inputs[0])
+  return same_attr_handler
+
+
+for attribute in ['color', 'shape', 'material', 'size', 'objectcategory']:
+  clevr_bitmask_handlers.add('filter_' + attribute,
+                             make_filter_bitmask_handler(attribute))
+for attribute in ['color', 'shape', 'material', 'size']:
+  clevr_bitmask_handlers.add('same_' + attribute,
+                             make_same_attr_bitmask_handler(attribute))
+
+bitmask_execute_handlers = clevr_bitmask_handlers.handlers
+
+# Visual Genome-style scenes use the CLEVR handlers, except that relate nodes
+# read a list of relationship records rather than per-object adjacency lists
+vg_handlers = clevr_handlers.copy('vg')
+vg_handlers.add('relate', vg_relate_handler)
+vg_bitmask_handlers = clevr_bitmask_handlers.copy('vg_bitmask')
+vg_bitmask_handlers.add('relate', vg_relate_bitmask_handler)
+
+# Node types whose output is an ObjectSet; in bitmask mode these outputs are
+# converted back to sorted lists of object indices before being returned.
+object_set_node_types = {
+  'scene', 'filter_color', 'filter_shape', 'filter_material', 'filter_size',
+  'filter_objectcategory', 'filter_fused', 'relate', 'union', 'intersect', 'same_color',
+  'same_shape', 'same_size', 'same_material',
+}
+
+
+# Short-circuit evaluation. In lazy mode, answer_question does not materialize
+# chains of filters whose only consumer is an exist, unique or count node;
+# instead the consumer tests the objects of the chain's input against all of the
+# filters at once and stops as soon as the answer is known (at the first match
+# for exist, or at the second match for unique). Filter handlers are recognized
+# by their filter_attribute, so chains of custom filters are left alone. Plans
+# for answer_question are kept in a side cache keyed by the structure of the
+# program, so questions are never modified; compiled programs (see
+# compile_program) are planned once when they are compiled.
+
+short_circuit_kinds = {
+  exist_handler: 'exist',
+  unique_handler: 'unique',
+  count_handler: 'count',
+  exist_bitmask_handler: 'exist',
+  unique_bitmask_handler: 'unique',
+  count_bitmask_handler: 'count',
 }
 
 
+def plan_short_circuit(nodes, raw_handlers, output_idxs=None):
+  """
+  Find the filter chains of a program that can be short-circuited. Returns a
+  dict mapping the index of each consumer node to a tuple (kind, source_idx,
+  attribute_values), where source_idx is the input of the chain and
+  attribute_values lists the (attribute, value) pairs of its filters, and
+  mapping the index of every filter in a chain to None. Returns None if
+  nothing can be short-circuited.
+
+  output_idxs lists the nodes whose outputs are returned to the caller (by
+  default only the last node); each counts as a use of the node, so that they
+  are never skipped. This matters for DAGs of merged programs, where a filter
+  can end one program and also feed a consumer in another.
+  """
+  if output_idxs is None:
+    output_idxs = [len(nodes) - 1]
+  num_uses = [0] * len(nodes)
+  for node in nodes:
+    for idx in node['inputs']:
+      num_uses[idx] += 1
+  for idx in output_idxs:
+    num_uses[idx] += 1
+  plan = {}
+  for i, node in enumerate(nodes):
+    kind = short_circuit_kinds.get(raw_handlers.get(node['type']))
+    if kind is None:
+      continue
+    j = node['inputs'][0]
+    attribute_values = []
+    while num_uses[j] == 1:
+      handler = raw_handlers.get(nodes[j]['type'])
+      attribute = getattr(handler, 'filter_attribute', None)
+      if attribute is None:
+        break
+      side_inputs = nodes[j].get('side_inputs', nodes[j].get('value_inputs'))
+      attribute_values.append((attribute, side_inputs[0]))
+      plan[j] = None
+      j = nodes[j]['inputs'][0]
+    if attribute_values:
+      plan[i] = (kind, j, attribute_values)
+  return plan or None
+
+
+# Maps (registry name, program structure) to the result of plan_short_circuit
+_short_circuit_plans = {}
+max_short_circuit_plans = 2 ** 16
+
+
+def get_short_circuit_plan(nodes, handlers):
+  """
+  Return plan_short_circuit for a program and a HandlerRegistry, using a
+  cache keyed by the types, inputs and side inputs of the nodes; the cache is
+  cleared when it holds more than max_short_circuit_plans plans.
+  """
+  key = (handlers.name, tuple([(n['type'], tuple(n['inputs']),
+                                tuple(n.get('side_inputs', ())))
+                               for n in nodes]))
+  plan = _short_circuit_plans.get(key, _missing)
+  if plan is _missing:
+    if len(_short_circuit_plans) >= max_short_circuit_plans:
+      _short_circuit_plans.clear()
+    plan = plan_short_circuit(nodes, handlers.raw_handlers)
+    _short_circuit_plans[key] = plan
+  return plan
+
+
+def short_circuit(scene_struct, kind, objs, attribute_values, use_bitmasks):
+  """
+  Compute the output of an exist, unique or count node applied to the objects
+  in objs (a list, or a bitmask if use_bitmasks is True) that pass all of the
+  given filters, without building the intermediate ObjectSets.
+  """
+  index = get_scene_index(scene_struct)
+  mask = index.all_mask
+  for attribute, value in attribute_values:
+    mask &= index.get_value_mask(attribute, value)
+    if mask == 0:
+      break
+  if use_bitmasks:
+    mask &= objs
+    if kind == 'exist':
+      return mask != 0
+    if kind == 'count':
+      return popcount(mask)
+    if mask == 0 or mask & (mask - 1) != 0:
+      return '__INVALID__'
+    return mask.bit_length() - 1
+  if kind == 'exist':
+    for idx in objs:
+      if (mask >> idx) & 1:
+        return True
+    return False
+  if kind == 'count':
+    return sum((mask >> idx) & 1 for idx in objs)
+  found = None
+  for idx in objs:
+    if (mask >> idx) & 1:
+      if found is not None:
+        return '__INVALID__'
+      found = idx
+  if found is None:
+    return '__INVALID__'
+  return found
+
+
+_scene_keys = itertools.count()
+_missing = object()
+
+
+class SceneKey(object):
+  """
+  Identifies a scene in caches. Copying or pickling a key gives a new key, so
+  a copy of a scene never shares cached outputs with the original.
+  """
+  __slots__ = ['value']
+
+  def __init__(self):
+    self.value = next(_scene_keys)
+
+  def __reduce__(self):
+    return (SceneKey, ())
+
+  def __repr__(self):
+    return 'SceneKey(%d)' % self.value
+
+
+def get_scene_key(scene_struct):
+  """
+  Return a key identifying this scene in caches. Keys are assigned the first
+  time a scene is seen and stored in the scene itself; if a scene is modified
+  in place, call invalidate_scene before answering questions on it again.
+  """
+  if '_cache_key' not in scene_struct:
+    scene_struct['_cache_key'] = SceneKey()
+  return scene_struct['_cache_key']
+
+
+class NodeOutputCache(object):
+  """
+  Cache of node outputs, keyed by scene and by sub-program.
+
+  The sub-program key of a node identifies the node together with everything
+  upstream of it: two nodes in different programs have the same key iff they
+  have the same type and value inputs and their inputs have the same keys, so
+  the output of a shared prefix is computed once per scene no matter which
+  program (or which copy of a program) it appears in. Sub-program keys are
+  interned as small integers so that lookups do not need to hash whole
+  programs.
+
+  Memory is bounded in three ways: outputs are grouped by scene and only the
+  max_scenes most recently used scenes are kept; the outputs for a scene are
+  dropped once there are more than max_outputs_per_scene of them; and the
+  intern table is dropped, together with all cached outputs, once it grows
+  past max_sub_programs entries. Dropping the intern table invalidates any
+  sub-program keys held by callers, so generation is incremented whenever
+  that happens.
+
+  Unlike caching outputs in the program nodes themselves, this never modifies
+  programs, so programs may be shared freely between scenes.
+  """
+  def __init__(self, max_scenes=16, max_outputs_per_scene=2 ** 16,
+               max_sub_programs=2 ** 20):
+    self.max_scenes = max_scenes
+    self.max_outputs_per_scene = max_outputs_per_scene
+    self.max_sub_programs = max_sub_programs
+    self.scene_outputs = OrderedDict()
+    self.sub_program_keys = {}
+    self.generation = 0
+
+  def clear(self):
+    self.scene_outputs.clear()
+    self.sub_program_keys.clear()
+    self.generation += 1
+
+  def get_scene_outputs(self, scene_struct):
+    """
+    Return the dict mapping sub-program keys to outputs for a scene.
+    """
+    scene_key = get_scene_key(scene_struct)
+    outputs = self.scene_outputs.get(scene_key)
+    if outputs is None or len(outputs) > self.max_outputs_per_scene:
+      outputs = {}
+      self.scene_outputs[scene_key] = outputs
+      if len(self.scene_outputs) > self.max_scenes:
+        self.scene_outputs.popitem(last=False)
+    self.scene_outputs.move_to_end(scene_key)
+    if len(self.sub_program_keys) > self.max_sub_programs:
+      self.clear()
+      return self.get_scene_outputs(scene_struct)
+    return outputs
+
+  def get_node_key(self, node, input_keys, registry_name='clevr'):
+    """
+    Return the sub-program key of node, given the sub-program keys of the
+    program's earlier nodes and the name of the handler registry used to
+    execute it.
+    """
+    inputs = node['inputs']
+    if len(inputs) == 1:
+      upstream = input_keys[inputs[0]]
+    else:
+      upstream = tuple([input_keys[idx] for idx in inputs])
+    side_inputs = node.get('side_inputs')
+    if side_inputs:
+      key = (node['type'], upstream, registry_name, tuple(side_inputs))
+    else:
+      key = (node['type'], upstream, registry_name)
+    node_key = self.sub_program_keys.get(key)
+    if node_key is None:
+      node_key = len(self.sub_program_keys)
+      self.sub_program_keys[key] = node_key
+    return node_key
+
+
+# Default cache used by answer_question
+node_output_cache = NodeOutputCache()
+
+
 def answer_question(question, metadata, scene_struct, all_outputs=False,
-                    cache_outputs=True):
+                    cache_outputs=True, use_bitmasks=False, handlers=None,
+                    lazy=False):
   """
   Use structured scene information to answer a structured question. Most of the
   heavy lifting is done by the execute handlers defined above.
 
-  We cache node outputs in the node itself; this gives a nontrivial speedup
-  when we want to answer many questions that share nodes on the same scene
-  (such as during question-generation DFS). This will NOT work if the same
-  nodes are executed on different scenes.
+  If cache_outputs is True then node outputs are cached in node_output_cache,
+  keyed by the scene and the sub-program ending at each node; this gives a
+  nontrivial speedup when we want to answer many questions that share nodes on
+  the same scene (such as during question-generation DFS).
+
+  If use_bitmasks is True then ObjectSets are represented internally as integer
+  bitmasks (see the bitmask handlers above); ObjectSet outputs are converted
+  back to sorted lists before being returned, so the result is the same as in
+  the default mode.
+
+  handlers is the HandlerRegistry used to execute the program; by default this
+  is clevr_handlers, or clevr_bitmask_handlers if use_bitmasks is True. If it
+  is given then use_bitmasks is taken from the registry.
+
+  If lazy is True then filter chains feeding exist, unique and count nodes are
+  short-circuited (see plan_short_circuit). The outputs of the filters in these
+  chains are never computed, so lazy mode is ignored if all_outputs is True.
   """
-  all_input_types, all_output_types = [], []
+  if handlers is None:
+    handlers = clevr_bitmask_handlers if use_bitmasks else clevr_handlers
+  use_bitmasks = handlers.bitmask
+  plan = None
+  if lazy and not all_outputs:
+    plan = get_short_circuit_plan(question['nodes'], handlers)
   node_outputs = []
-  for node in question['nodes']:
-    if cache_outputs and '_output' in node:
-      node_output = node['_output']
-    else:
-      node_type = node['type']
-      msg = 'Could not find handler for "%s"' % node_type
-      assert node_type in execute_handlers, msg
-      handler = execute_handlers[node_type]
-      node_inputs = [node_outputs[idx] for idx in node['inputs']]
-      side_inputs = node.get('side_inputs', [])
-      node_output = handler(scene_struct, node_inputs, side_inputs)
-      if cache_outputs:
-        node['_output'] = node_output
-    node_outputs.append(node_output)
-    if node_output == '__INVALID__':
-      break
+  node_keys = [] if cache_outputs else None
+  _execute_nodes(question['nodes'], node_outputs, node_keys, scene_struct,
+                 handlers, plan)
+
+  if use_bitmasks:
+    # Convert ObjectSet outputs back to lists at the program boundary
+    nodes = question['nodes']
+    if all_outputs:
+      for i, node_output in enumerate(node_outputs):
+        if nodes[i]['type'] in object_set_node_types:
+          node_outputs[i] = mask_to_list(node_output)
+    elif node_outputs[-1] != '__INVALID__':
+      if nodes[len(node_outputs) - 1]['type'] in object_set_node_types:
+        node_outputs[-1] = mask_to_list(node_outputs[-1])
 
   if all_outputs:
     return node_outputs
@@ -216,6 +884,122 @@ def answer_question(question, metadata, scene_struct, all_outputs=False,
     return node_outputs[-1]
 
 
+def answer_question_incremental(new_nodes, metadata, scene_struct,
+                                prefix_outputs=(), prefix_keys=None,
+                                cache_outputs=True, handlers=None):
+  """
+  Evaluate a program whose first nodes have already been evaluated, such as
+  a partial program that is extended step by step during question generation.
+
+  prefix_outputs are the outputs of the first nodes of the program, as
+  returned by an earlier call to this function, and new_nodes are the nodes
+  that follow them; node inputs index into the whole program. Only new_nodes
+  are executed, so the cost does not depend on the length of the prefix.
+  prefix_keys are the sub-program keys of the prefix as returned by the same
+  earlier call, which are needed to cache outputs in node_output_cache.
+
+  Returns a tuple (outputs, keys), where outputs is a new list holding the
+  outputs of the whole program and keys is an opaque value holding its
+  sub-program keys (see NodeOutputCache); they can be passed as
+  prefix_outputs and prefix_keys to evaluate programs extending this one. If
+  cache_outputs is False, if prefix_keys is missing for a nonempty prefix, or
+  if the cache has been cleared since prefix_keys were computed (which makes
+  them meaningless), the nodes are executed without the cache and keys is
+  None. As in answer_question with all_outputs=True, outputs stops after the
+  first node whose output is '__INVALID__'. Unlike answer_question,
+  ObjectSets are left in the representation used by handlers (bitmasks for
+  bitmask registries).
+  """
+  if handlers is None:
+    handlers = clevr_handlers
+  node_outputs = list(prefix_outputs)
+  node_keys = None
+  scene_outputs = None
+  if cache_outputs:
+    cache = node_output_cache
+    # Looking up the scene may clear the cache, so it must happen before the
+    # generation of prefix_keys is checked
+    scene_outputs = cache.get_scene_outputs(scene_struct)
+    if not node_outputs:
+      node_keys = []
+    elif prefix_keys is not None and prefix_keys[0] == cache.generation:
+      node_keys = list(prefix_keys[1])
+  _execute_nodes(new_nodes, node_outputs, node_keys, scene_struct, handlers,
+                 scene_outputs=scene_outputs)
+  if node_keys is None:
+    return node_outputs, None
+  return node_outputs, (node_output_cache.generation, node_keys)
+
+
+def _execute_nodes(nodes, node_outputs, node_keys, scene_struct, handlers,
+                   plan=None, scene_outputs=None):
+  """
+  Execute nodes with the HandlerRegistry handlers, appending their outputs to
+  node_outputs, which holds the outputs of any earlier nodes of the program
+  that node inputs refer to. If node_keys is not None then it holds the
+  sub-program keys of the earlier nodes; the keys of nodes are appended to it
+  and their outputs are cached in node_output_cache; scene_outputs is the
+  scene's dict of outputs in the cache, if the caller has already fetched it.
+  Stops after the first node whose output is '__INVALID__'. plan is a
+  short-circuit plan as returned by plan_short_circuit, indexed by position
+  in nodes.
+  """
+  use_bitmasks = handlers.bitmask
+  registry_name = handlers.name
+  handlers = handlers.handlers
+  cache_outputs = node_keys is not None
+  if cache_outputs:
+    cache = node_output_cache
+    if scene_outputs is None:
+      scene_outputs = cache.get_scene_outputs(scene_struct)
+    sub_program_keys = cache.sub_program_keys
+  for i, node in enumerate(nodes):
+    node_output = _missing
+    if cache_outputs:
+      # This is NodeOutputCache.get_node_key, inlined since it is called for
+      # every node during question generation
+      inputs = node['inputs']
+      if len(inputs) == 1:
+        upstream = node_keys[inputs[0]]
+      else:
+        upstream = tuple([node_keys[idx] for idx in inputs])
+      side_inputs = node.get('side_inputs')
+      if side_inputs:
+        key = (node['type'], upstream, registry_name, tuple(side_inputs))
+      else:
+        key = (node['type'], upstream, registry_name)
+      node_key = sub_program_keys.get(key)
+      if node_key is None:
+        node_key = len(sub_program_keys)
+        sub_program_keys[key] = node_key
+      else:
+        node_output = scene_outputs.get(node_key, _missing)
+      node_keys.append(node_key)
+    if node_output is _missing:
+      node_plan = plan.get(i, _missing) if plan is not None else _missing
+      if node_plan is None:
+        # A filter in a short-circuited chain; its output is never used
+        node_outputs.append(None)
+        continue
+      elif node_plan is not _missing:
+        kind, source_idx, attribute_values = node_plan
+        node_output = short_circuit(scene_struct, kind, node_outputs[source_idx],
+                                    attribute_values, use_bitmasks)
+      else:
+        node_type = node['type']
+        msg = 'Could not find handler for "%s"' % node_type
+        assert node_type in handlers, msg
+        handler = handlers[node_type]
+        node_inputs = [node_outputs[idx] for idx in node['inputs']]
+        side_inputs = node.get('side_inputs', [])
+        node_output = handler(scene_struct, node_inputs, side_inputs)
+      if cache_outputs:
+        scene_outputs[node_key] = node_output
+    node_outputs.append(node_output)
+    if node_output == '__INVALID__':
+      break
+
+
 def insert_scene_node(nodes, idx):
   # First make a shallow-ish copy of the input
   new_nodes = []
@@ -259,27 +1043,116 @@ def insert_scene_node(nodes, idx):
   return new_nodes_trimmed
 
 
-def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False):
+def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False,
+                  use_bitmasks=False, outputs=None, handlers=None):
   """
   A question is degenerate if replacing any of its relate nodes with a scene
   node results in a question with the same answer.
+
+  Rather than building and answering a new question for each relate node, we
+  reuse the outputs of the original question and only re-evaluate the nodes
+  downstream of the replaced relate node whose inputs actually changed; as soon
+  as no changed outputs remain, the answer is known to be unchanged. If the
+  caller has already answered the question it can pass the outputs of all
+  nodes (as returned by answer_question with all_outputs=True) as outputs.
+  handlers is as for answer_question.
   """
+  nodes = question['nodes']
+  if not any(node['type'] == 'relate' for node in nodes):
+    return False
+  if handlers is None:
+    handlers = clevr_bitmask_handlers if use_bitmasks else clevr_handlers
+  if outputs is None:
+    outputs = answer_question(question, metadata, scene_struct,
+                              all_outputs=True, handlers=handlers)
   if answer is None:
-    answer = answer_question(question, metadata, scene_struct)
+    answer = outputs[-1]
+  if len(outputs) < len(nodes):
+    # The question itself is invalid; fall back to answering each of the
+    # modified questions from scratch.
+    return _is_degenerate_full(question, metadata, scene_struct, answer,
+                               verbose, handlers)
 
+  if handlers.bitmask:
+    outputs = [list_to_mask(o) if n['type'] in object_set_node_types else o
+               for n, o in zip(nodes, outputs)]
+  handlers = handlers.handlers
+  scene_output = handlers['scene'](scene_struct, [], [])
+
+  # Only nodes that the final node depends on can affect the answer; for each
+  # of them record which of its inputs are used
+  output_used = [False] * len(nodes)
+  idxs_to_check = [len(nodes) - 1]
+  while idxs_to_check:
+    cur_idx = idxs_to_check.pop()
+    output_used[cur_idx] = True
+    idxs_to_check.extend(nodes[cur_idx]['inputs'])
+
+  for idx, node in enumerate(nodes):
+    if node['type'] != 'relate' or not output_used[idx]:
+      continue
+    # Maps indices of nodes whose output differs from the original question
+    # to their new outputs
+    changed = {}
+    if scene_output != outputs[idx]:
+      changed[idx] = scene_output
+    new_answer = answer
+    for i in range(idx + 1, len(nodes)):
+      if not changed:
+        break
+      if not output_used[i]:
+        continue
+      n = nodes[i]
+      for j in n['inputs']:
+        if j in changed:
+          break
+      else:
+        continue
+      node_inputs = [changed[j] if j in changed else outputs[j]
+                     for j in n['inputs']]
+      handler = handlers[n['type']]
+      new_output = handler(scene_struct, node_inputs, n.get('side_inputs', []))
+      if new_output == '__INVALID__':
+        new_answer = new_output
+        break
+      if new_output != outputs[i]:
+        changed[i] = new_output
+    else:
+      new_answer = changed.get(len(nodes) - 1, answer)
+
+    if verbose:
+      print('replacing node %d with a scene node:' % idx)
+      for i, n in enumerate(nodes):
+        if i in changed:
+          name = n['type']
+          if 'side_inputs' in n:
+            name = '%s[%s]' % (name, n['side_inputs'][0])
+          print(i, name, changed[i])
+      print('new answer is: ', new_answer)
+
+    if new_answer == answer:
+      return True
+
+  return False
+
+
+def _is_degenerate_full(question, metadata, scene_struct, answer, verbose,
+                        handlers):
   for idx, node in enumerate(question['nodes']):
     if node['type'] == 'relate':
       new_question = {
         'nodes': insert_scene_node(question['nodes'], idx)
       }
-      new_answer = answer_question(new_question, metadata, scene_struct)
+      new_outputs = answer_question(new_question, metadata, scene_struct,
+                                    all_outputs=True, handlers=handlers)
+      new_answer = new_outputs[-1]
       if verbose:
         print('here is truncated question:')
         for i, n in enumerate(new_question['nodes']):
           name = n['type']
           if 'side_inputs' in n:
             name = '%s[%s]' % (name, n['side_inputs'][0])
-          print(i, name, n['_output'])
+          print(i, name, new_outputs[i] if i < len(new_outputs) else None)
         print('new answer is: ', new_answer)
 
       if new_answer == answer:
@@ -287,3 +1160,1015 @@ def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False):
 
   return False
 
+
+# Compiled programs. answer_question interprets a program node by node, looking
+# up handlers and rebuilding inputs on every call; when the same program will be
+# executed many times (for example when verifying a question file, or answering
+# a program on several versions of a scene) it is faster to compile it once.
+# Compilation validates the program against the function signatures from the
+# metadata file and turns each node into a kernel with its inputs and value
+# inputs already bound; kernels work with bitmask ObjectSets and do no
+# validation of their own.
+
+
+def _make_scene_kernel(inputs, side_inputs):
+  def kernel(index, scene_struct, outputs):
+    return index.all_mask
+  return kernel
+
+
+def _make_filter_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i, value = inputs[0], side_inputs[0]
+    def kernel(index, scene_struct, outputs):
+      return outputs[i] & index.get_value_mask(attribute, value)
+    return kernel
+  return make_kernel
+
+
+def _make_filter_fused_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] & index.get_filter_mask(side_inputs)
+  return kernel
+
+
+def _make_unique_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(index, scene_struct, outputs):
+    mask = outputs[i]
+    if mask == 0 or mask & (mask - 1) != 0:
+      return '__INVALID__'
+    return mask.bit_length() - 1
+  return kernel
+
+
+def _make_relate_kernel(inputs, side_inputs):
+  i, relation = inputs[0], side_inputs[0]
+  def kernel(index, scene_struct, outputs):
+    return index.get_relate_mask(relation, outputs[i])
+  return kernel
+
+
+def _make_union_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] | outputs[j]
+  return kernel
+
+
+def _make_intersect_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] & outputs[j]
+  return kernel
+
+
+def _make_count_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(index, scene_struct, outputs):
+    return popcount(outputs[i])
+  return kernel
+
+
+def _make_exist_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] != 0
+  return kernel
+
+
+def _make_query_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i = inputs[0]
+    def kernel(index, scene_struct, outputs):
+      return index.get_query_value(attribute, outputs[i])
+    return kernel
+  return make_kernel
+
+
+def _make_same_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i = inputs[0]
+    def kernel(index, scene_struct, outputs):
+      return index.get_same_mask(attribute, outputs[i])
+    return kernel
+  return make_kernel
+
+
+def _make_equal_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] == outputs[j]
+  return kernel
+
+
+def _make_less_than_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] < outputs[j]
+  return kernel
+
+
+def _make_greater_than_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(index, scene_struct, outputs):
+    return outputs[i] > outputs[j]
+  return kernel
+
+
+def _make_handler_kernel_maker(handler):
+  # Fallback for node types without a specialized kernel; this simply calls
+  # the bitmask handler with pre-resolved inputs.
+  def make_kernel(inputs, side_inputs):
+    def kernel(index, scene_struct, outputs):
+      node_inputs = [outputs[idx] for idx in inputs]
+      return handler(scene_struct, node_inputs, side_inputs)
+    return kernel
+  return make_kernel
+
+
+kernel_makers = {
+  'scene': _make_scene_kernel,
+  'filter_color': _make_filter_kernel_maker('color'),
+  'filter_shape': _make_filter_kernel_maker('shape'),
+  'filter_material': _make_filter_kernel_maker('material'),
+  'filter_size': _make_filter_kernel_maker('size'),
+  'filter_objectcategory': _make_filter_kernel_maker('objectcategory'),
+  'filter_fused': _make_filter_fused_kernel,
+  'unique': _make_unique_kernel,
+  'relate': _make_relate_kernel,
+  'union': _make_union_kernel,
+  'intersect': _make_intersect_kernel,
+  'count': _make_count_kernel,
+  'query_color': _make_query_kernel_maker('color'),
+  'query_shape': _make_query_kernel_maker('shape'),
+  'query_material': _make_query_kernel_maker('material'),
+  'query_size': _make_query_kernel_maker('size'),
+  'exist': _make_exist_kernel,
+  'equal_color': _make_equal_kernel,
+  'equal_shape': _make_equal_kernel,
+  'equal_integer': _make_equal_kernel,
+  'equal_material': _make_equal_kernel,
+  'equal_size': _make_equal_kernel,
+  'equal_object': _make_equal_kernel,
+  'less_than': _make_less_than_kernel,
+  'greater_than': _make_greater_than_kernel,
+  'same_color': _make_same_kernel_maker('color'),
+  'same_shape': _make_same_kernel_maker('shape'),
+  'same_size': _make_same_kernel_maker('size'),
+  'same_material': _make_same_kernel_maker('material'),
+}
+
+
+def get_functions_by_name(metadata):
+  if '_functions_by_name' not in metadata:
+    functions_by_name = {}
+    for f in metadata['functions']:
+      functions_by_name[f['name']] = f
+    metadata['_functions_by_name'] = functions_by_name
+  return metadata['_functions_by_name']
+
+
+# Signatures of node types that are not in the metadata because they are only
+# produced by optimize_program; their value inputs are not checked.
+internal_functions = {
+  'filter_fused': {
+    'name': 'filter_fused',
+    'inputs': ['ObjectSet'],
+    'output': 'ObjectSet',
+    'side_inputs': None,
+  },
+}
+
+
+def validate_program(nodes, metadata, handlers=None):
+  """
+  Check a program against the function signatures in the metadata, raising a
+  ValueError describing the first problem found. Returns the list of output
+  types of the nodes.
+  """
+  functions_by_name = get_functions_by_name(metadata)
+  output_types = []
+  for i, node in enumerate(nodes):
+    node_type = node['type']
+    f = functions_by_name.get(node_type, internal_functions.get(node_type))
+    if f is None:
+      raise ValueError('Node %d has unknown type "%s"' % (i, node_type))
+    if f.get('template_only', False):
+      raise ValueError('Node %d has template-only type "%s"' % (i, node_type))
+    if handlers is not None:
+      has_handler = node_type in handlers
+    else:
+      has_handler = (node_type in kernel_makers
+                     or node_type in bitmask_execute_handlers)
+    if not has_handler:
+      raise ValueError('Could not find handler for "%s"' % node_type)
+
+    if len(node['inputs']) != len(f['inputs']):
+      raise ValueError('Node %d (%s) expected %d inputs but got %d'
+                       % (i, node_type, len(f['inputs']), len(node['inputs'])))
+    for idx, input_type in zip(node['inputs'], f['inputs']):
+      if not 0 <= idx < i:
+        raise ValueError('Node %d (%s) has invalid input %d'
+                         % (i, node_type, idx))
+      if output_types[idx] != input_type:
+        raise ValueError('Node %d (%s) expected input of type %s but got %s'
+                         % (i, node_type, input_type, output_types[idx]))
+
+    side_inputs = node.get('side_inputs', node.get('value_inputs', []))
+    side_input_types = f.get('side_inputs', [])
+    if side_input_types is None:
+      side_input_types = side_inputs = []
+    if len(side_inputs) != len(side_input_types):
+      raise ValueError('Node %d (%s) expected %d value inputs but got %d'
+                       % (i, node_type, len(side_input_types), len(side_inputs)))
+    for val, val_type in zip(side_inputs, side_input_types):
+      allowed = metadata['types'].get(val_type)
+      if allowed is not None and val not in allowed:
+        raise ValueError('Node %d (%s) has invalid %s value "%s"'
+                         % (i, node_type, val_type, val))
+    output_types.append(f['output'])
+  return output_types
+
+
+class CompiledProgram(object):
+  """
+  A program that has been validated and compiled into a flat list of kernels;
+  use compile_program to build one. A compiled program does not depend on any
+  particular scene, and can be executed on any number of scenes. If lazy is
+  True then the outputs of short-circuited filters are None, so only the
+  final answer of the program should be used.
+  """
+  def __init__(self, nodes, kernels, output_types, lazy=False):
+    self.nodes = nodes
+    self.kernels = kernels
+    self.lazy = lazy
+    self.inputs = [list(node['inputs']) for node in nodes]
+    self.output_types = output_types
+    self.object_set_idxs = [i for i, t in enumerate(output_types)
+                            if t == 'ObjectSet']
+    self._batch_kernels = None
+
+  def execute(self, scene_struct, all_outputs=False):
+    """
+    Execute the program on a scene. The return value is the same as that of
+    answer_question, with ObjectSets given as sorted lists of object indices.
+    """
+    assert not (all_outputs and self.lazy), 'Lazy programs only give answers'
+    outputs = self.execute_masks(scene_struct)
+    if not all_outputs:
+      if (outputs[-1] != '__INVALID__'
+          and self.output_types[len(outputs) - 1] == 'ObjectSet'):
+        return mask_to_list(outputs[-1])
+      return outputs[-1]
+    for i in self.object_set_idxs:
+      if i >= len(outputs):
+        break
+      outputs[i] = mask_to_list(outputs[i])
+    return outputs
+
+  def get_batch_kernels(self):
+    """
+    Return kernels for batched execution across scenes (see execute_batch), or
+    None if some node type has no batched kernel.
+    """
+    if self._batch_kernels is None:
+      if any(n['type'] not in batch_kernel_makers for n in self.nodes):
+        return None
+      self._batch_kernels = []
+      for node in self.nodes:
+        side_inputs = node.get('side_inputs', node.get('value_inputs', []))
+        make_kernel = batch_kernel_makers[node['type']]
+        self._batch_kernels.append(make_kernel(list(node['inputs']),
+                                               list(side_inputs)))
+    return self._batch_kernels
+
+  def execute_masks(self, scene_struct):
+    """
+    Execute the program on a scene, returning the output of each node up to
+    and including the first invalid one; ObjectSets are given as bitmasks.
+    """
+    index = get_scene_index(scene_struct)
+    outputs = []
+    for kernel in self.kernels:
+      output = kernel(index, scene_struct, outputs)
+      outputs.append(output)
+      if output == '__INVALID__':
+        break
+    return outputs
+
+
+  def execute_dag_masks(self, scene_struct):
+    """
+    Execute every node of the program on a scene, returning the output of each
+    node with ObjectSets given as bitmasks. Unlike execute_masks this does not
+    stop at the first invalid node; instead a node is invalid iff one of its
+    inputs is, which is what we want when the nodes come from several merged
+    programs (see answer_questions).
+    """
+    index = get_scene_index(scene_struct)
+    outputs = []
+    for kernel, inputs in zip(self.kernels, self.inputs):
+      for idx in inputs:
+        if outputs[idx] == '__INVALID__':
+          outputs.append('__INVALID__')
+          break
+      else:
+        outputs.append(kernel(index, scene_struct, outputs))
+    return outputs
+
+
+def _make_short_circuit_kernel(kind, source_idx, attribute_values):
+  def kernel(index, scene_struct, outputs):
+    return short_circuit(scene_struct, kind, outputs[source_idx],
+                         attribute_values, True)
+  return kernel
+
+
+def _skipped_filter_kernel(index, scene_struct, outputs):
+  # A filter in a short-circuited chain; its output is never used
+  return None
+
+
+def compile_program(nodes, metadata, handlers=None, lazy=False,
+                    output_idxs=None):
+  """
+  Validate a program (a list of nodes, in either the format produced during
+  question generation or the released format using "value_inputs") against the
+  metadata and compile it into a CompiledProgram. Raises a ValueError if the
+  program is invalid.
+
+  By default nodes are compiled to specialized kernels; if handlers (a bitmask
+  HandlerRegistry) is given then every node calls its handler instead, so that
+  custom node types can be used and handler stats (if enabled on the registry
+  before compiling) are recorded.
+
+  If lazy is True then filter chains feeding exist, unique and count nodes are
+  short-circuited as in answer_question, and only the outputs of the nodes in
+  output_idxs (by default the last node) are meaningful.
+  """
+  if handlers is not None:
+    assert handlers.bitmask, 'Compiled programs require bitmask handlers'
+  output_types = validate_program(nodes, metadata, handlers=handlers)
+  plan = None
+  if lazy:
+    registry = handlers if handlers is not None else clevr_bitmask_handlers
+    plan = plan_short_circuit(nodes, registry.raw_handlers, output_idxs)
+  kernels = []
+  for i, node in enumerate(nodes):
+    node_type = node['type']
+    node_plan = plan.get(i, _missing) if plan is not None else _missing
+    if node_plan is None:
+      kernels.append(_skipped_filter_kernel)
+      continue
+    elif node_plan is not _missing:
+      kernels.append(_make_short_circuit_kernel(*node_plan))
+      continue
+    if handlers is not None:
+      make_kernel = _make_handler_kernel_maker(handlers.handlers[node_type])
+    elif node_type in kernel_makers:
+      make_kernel = kernel_makers[node_type]
+    else:
+      make_kernel = _make_handler_kernel_maker(bitmask_execute_handlers[node_type])
+    side_inputs = node.get('side_inputs', node.get('value_inputs', []))
+    kernels.append(make_kernel(list(node['inputs']), list(side_inputs)))
+  return CompiledProgram(nodes, kernels, output_types, lazy=lazy)
+
+
+# Program optimization. Template expansion emits chains of filters in a fixed
+# order (size, color, material, shape), with one node per filter; when a
+# program is executed many times it pays to fuse each chain into a single
+# filter_fused node, which builds one ObjectSet rather than one per filter and
+# tests the filters in the order that is cheapest for each scene it is executed
+# on (see SceneIndex.get_filter_mask).
+# Optimized programs are only used for execution; they are never written out.
+
+
+def optimize_program(nodes):
+  """
+  Return an equivalent program in which each chain of two or more filters,
+  where every filter but the last is used only by the next one, is replaced by
+  a single filter_fused node. The program does not depend on any scene; the
+  filters of each chain are ordered by their selectivity when it is executed.
+
+  Accepts programs in either format (side_inputs or value_inputs) and returns
+  a tuple (new_nodes, node_map) where new_nodes uses side_inputs and
+  node_map[i] is the index in new_nodes of the node computing the output of
+  nodes[i], or None if nodes[i] was fused into a later node.
+  """
+  raw_handlers = clevr_handlers.raw_handlers
+  num_uses = [0] * len(nodes)
+  for node in nodes:
+    for idx in node['inputs']:
+      num_uses[idx] += 1
+
+  # Maps the index of the last filter in each chain found so far to a tuple
+  # (source_idx, attribute_values)
+  chains, fused = {}, set()
+  for i, node in enumerate(nodes):
+    handler = raw_handlers.get(node['type'])
+    attribute = getattr(handler, 'filter_attribute', None)
+    if attribute is None:
+      continue
+    value = node.get('side_inputs', node.get('value_inputs'))[0]
+    j = node['inputs'][0]
+    if j in chains and num_uses[j] == 1:
+      source_idx, attribute_values = chains.pop(j)
+      fused.add(j)
+      chains[i] = (source_idx, attribute_values + [(attribute, value)])
+    else:
+      chains[i] = (j, [(attribute, value)])
+
+  new_nodes, node_map = [], []
+  for i, node in enumerate(nodes):
+    if i in fused:
+      node_map.append(None)
+      continue
+    if i in chains and len(chains[i][1]) > 1:
+      source_idx, attribute_values = chains[i]
+      side_inputs = []
+      for attribute, value in attribute_values:
+        side_inputs.extend([attribute, value])
+      new_node = {
+        'type': 'filter_fused',
+        'inputs': [node_map[source_idx]],
+        'side_inputs': side_inputs,
+      }
+    else:
+      new_node = {
+        'type': node['type'],
+        'inputs': [node_map[idx] for idx in node['inputs']],
+      }
+      side_inputs = node.get('side_inputs', node.get('value_inputs'))
+      if side_inputs:
+        new_node['side_inputs'] = list(side_inputs)
+    node_map.append(len(new_nodes))
+    new_nodes.append(new_node)
+  return new_nodes, node_map
+
+
+# Batched execution across scenes. To run one program on many scenes at once we
+# pad every scene to the same number of objects (a "lane" of bits) and pack the
+# ObjectSets of all scenes into a single integer, with scene k occupying bits
+# [k * lane_width, (k + 1) * lane_width). Filters, unions and intersections then
+# process every scene with a single integer operation; nodes that produce
+# Objects, Integers, Bools or attribute values give a list with one entry per
+# scene, with None for scenes where the program has already become invalid.
+
+
+class SceneBatch(object):
+  """
+  A group of scenes packed into fixed-width bit lanes for batched execution.
+  Lanes are padded to a whole number of bytes so that packing and unpacking
+  can go through int.to_bytes / int.from_bytes in linear time.
+  """
+  def __init__(self, scene_structs):
+    self.scene_structs = scene_structs
+    self.indexes = [get_scene_index(s) for s in scene_structs]
+    self.num_scenes = len(scene_structs)
+    max_objects = max([1] + [index.num_objects for index in self.indexes])
+    self.lane_bytes = (max_objects + 7) // 8
+    self.lane_width = 8 * self.lane_bytes
+    self.all_mask = self.pack([index.all_mask for index in self.indexes])
+    self._value_masks = {}
+    self._filter_masks = {}
+
+  def pack(self, masks):
+    lane_bytes = self.lane_bytes
+    data = b''.join(mask.to_bytes(lane_bytes, 'little') for mask in masks)
+    return int.from_bytes(data, 'little')
+
+  def unpack(self, packed):
+    lane_bytes = self.lane_bytes
+    data = packed.to_bytes(lane_bytes * self.num_scenes, 'little')
+    return [int.from_bytes(data[start:start + lane_bytes], 'little')
+            for start in range(0, len(data), lane_bytes)]
+
+  def get_value_mask(self, attribute, value):
+    key = (attribute, value)
+    if key not in self._value_masks:
+      masks = [index.get_value_mask(attribute, value) for index in self.indexes]
+      self._value_masks[key] = self.pack(masks)
+    return self._value_masks[key]
+
+  def get_filter_masks(self, attribute_values):
+    """
+    Return the packed masks for the tests of a filter_fused node, ordered by
+    the number of objects they match across the batch, fewest first.
+    """
+    key = tuple(attribute_values)
+    if key not in self._filter_masks:
+      masks = [self.get_value_mask(attribute_values[k], attribute_values[k + 1])
+               for k in range(0, len(attribute_values), 2)]
+      masks.sort(key=popcount)
+      self._filter_masks[key] = masks
+    return self._filter_masks[key]
+
+
+def _make_scene_batch_kernel(inputs, side_inputs):
+  def kernel(batch, outputs):
+    return batch.all_mask
+  return kernel
+
+
+def _make_filter_batch_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i, value = inputs[0], side_inputs[0]
+    def kernel(batch, outputs):
+      return outputs[i] & batch.get_value_mask(attribute, value)
+    return kernel
+  return make_kernel
+
+
+def _make_filter_fused_batch_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(batch, outputs):
+    output = outputs[i]
+    for value_mask in batch.get_filter_masks(side_inputs):
+      output &= value_mask
+      if output == 0:
+        break
+    return output
+  return kernel
+
+
+def _make_unique_batch_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(batch, outputs):
+    output = []
+    for mask in batch.unpack(outputs[i]):
+      if mask == 0 or mask & (mask - 1) != 0:
+        output.append('__INVALID__')
+      else:
+        output.append(mask.bit_length() - 1)
+    return output
+  return kernel
+
+
+def _make_relate_batch_kernel(inputs, side_inputs):
+  i, relation = inputs[0], side_inputs[0]
+  def kernel(batch, outputs):
+    masks = []
+    for index, idx in zip(batch.indexes, outputs[i]):
+      if idx is None:
+        masks.append(0)
+      else:
+        masks.append(index.get_relate_mask(relation, idx))
+    return batch.pack(masks)
+  return kernel
+
+
+def _make_union_batch_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(batch, outputs):
+    return outputs[i] | outputs[j]
+  return kernel
+
+
+def _make_intersect_batch_kernel(inputs, side_inputs):
+  i, j = inputs
+  def kernel(batch, outputs):
+    return outputs[i] & outputs[j]
+  return kernel
+
+
+def _make_count_batch_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(batch, outputs):
+    return [popcount(mask) for mask in batch.unpack(outputs[i])]
+  return kernel
+
+
+def _make_exist_batch_kernel(inputs, side_inputs):
+  i = inputs[0]
+  def kernel(batch, outputs):
+    return [mask != 0 for mask in batch.unpack(outputs[i])]
+  return kernel
+
+
+def _make_query_batch_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i = inputs[0]
+    def kernel(batch, outputs):
+      output = []
+      for index, idx in zip(batch.indexes, outputs[i]):
+        if idx is None:
+          output.append(None)
+        else:
+          output.append(index.get_query_value(attribute, idx))
+      return output
+    return kernel
+  return make_kernel
+
+
+def _make_same_batch_kernel_maker(attribute):
+  def make_kernel(inputs, side_inputs):
+    i = inputs[0]
+    def kernel(batch, outputs):
+      masks = []
+      for index, idx in zip(batch.indexes, outputs[i]):
+        if idx is None:
+          masks.append(0)
+        else:
+          masks.append(index.get_same_mask(attribute, idx))
+      return batch.pack(masks)
+    return kernel
+  return make_kernel
+
+
+def _make_compare_batch_kernel_maker(compare):
+  def make_kernel(inputs, side_inputs):
+    i, j = inputs
+    def kernel(batch, outputs):
+      output = []
+      for a, b in zip(outputs[i], outputs[j]):
+        if a is None or b is None:
+          output.append(None)
+        else:
+          output.append(compare(a, b))
+      return output
+    return kernel
+  return make_kernel
+
+
+batch_kernel_makers = {
+  'scene': _make_scene_batch_kernel,
+  'filter_color': _make_filter_batch_kernel_maker('color'),
+  'filter_shape': _make_filter_batch_kernel_maker('shape'),
+  'filter_material': _make_filter_batch_kernel_maker('material'),
+  'filter_size': _make_filter_batch_kernel_maker('size'),
+  'filter_objectcategory': _make_filter_batch_kernel_maker('objectcategory'),
+  'filter_fused': _make_filter_fused_batch_kernel,
+  'unique': _make_unique_batch_kernel,
+  'relate': _make_relate_batch_kernel,
+  'union': _make_union_batch_kernel,
+  'intersect': _make_intersect_batch_kernel,
+  'count': _make_count_batch_kernel,
+  'query_color': _make_query_batch_kernel_maker('color'),
+  'query_shape': _make_query_batch_kernel_maker('shape'),
+  'query_material': _make_query_batch_kernel_maker('material'),
+  'query_size': _make_query_batch_kernel_maker('size'),
+  'exist': _make_exist_batch_kernel,
+  'equal_color': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'equal_shape': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'equal_integer': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'equal_material': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'equal_size': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'equal_object': _make_compare_batch_kernel_maker(lambda a, b: a == b),
+  'less_than': _make_compare_batch_kernel_maker(lambda a, b: a < b),
+  'greater_than': _make_compare_batch_kernel_maker(lambda a, b: a > b),
+  'same_color': _make_same_batch_kernel_maker('color'),
+  'same_shape': _make_same_batch_kernel_maker('shape'),
+  'same_size': _make_same_batch_kernel_maker('size'),
+  'same_material': _make_same_batch_kernel_maker('material'),
+}
+
+
+# Kernels for nodes whose value inputs differ between the scenes of a batch,
+# used to execute a whole family of programs together (see
+# answer_questions_batch). They take a list with the value inputs for each
+# scene in place of the value inputs of the node.
+
+def _make_filter_fused_lane_kernel(inputs, lane_side_inputs):
+  i = inputs[0]
+  if not any(lane_side_inputs):
+    def kernel(batch, outputs):
+      return outputs[i]
+    return kernel
+  def kernel(batch, outputs):
+    masks = [index.get_filter_mask(side_inputs) for index, side_inputs
+             in zip(batch.indexes, lane_side_inputs)]
+    return outputs[i] & batch.pack(masks)
+  return kernel
+
+
+def _make_relate_lane_kernel(inputs, lane_side_inputs):
+  i = inputs[0]
+  def kernel(batch, outputs):
+    masks = []
+    for index, idx, side_inputs in zip(batch.indexes, outputs[i],
+                                       lane_side_inputs):
+      if idx is None:
+        masks.append(0)
+      else:
+        masks.append(index.get_relate_mask(side_inputs[0], idx))
+    return batch.pack(masks)
+  return kernel
+
+
+lane_kernel_makers = {
+  'filter_fused': _make_filter_fused_lane_kernel,
+  'relate': _make_relate_lane_kernel,
+}
+
+
+def _get_family_checks(metadata):
+  """
+  Return a dict used by _split_program, mapping each node type that may
+  appear in a program to a tuple (attribute, allowed): for filters, attribute
+  is the attribute they test and allowed the set of values it may take (or
+  None for any value); for other node types, attribute is None and allowed
+  lists the allowed values of each of their value inputs in the same way.
+  """
+  if '_family_checks' in metadata:
+    return metadata['_family_checks']
+  functions_by_name = get_functions_by_name(metadata)
+  checks = {}
+  for name, f in functions_by_name.items():
+    if f.get('template_only', False):
+      continue
+    allowed = [metadata['types'].get(t) for t in f.get('side_inputs') or []]
+    allowed = [None if a is None else frozenset(a) for a in allowed]
+    handler = clevr_handlers.raw_handlers.get(name)
+    attribute = getattr(handler, 'filter_attribute', None)
+    if attribute is not None and len(allowed) == 1:
+      checks[name] = (attribute, allowed[0])
+    else:
+      checks[name] = (None, allowed)
+  metadata['_family_checks'] = checks
+  return checks
+
+
+def _split_program(nodes, checks):
+  """
+  Split a program into the structure it shares with the other programs of
+  its family and its own value inputs. Every chain of filters becomes a single
+  filter_fused node, and an empty filter_fused node is added wherever the
+  ObjectSet of some other node is used directly, so that the programs
+  instantiated from one template have the same structure whichever of their
+  filters are present.
+
+  Returns a tuple (key, side_inputs), where key lists the type and inputs of
+  each node of the family structure and side_inputs gives the value inputs of
+  each of them for this program (a flat (attribute, value, ...) tuple for
+  filter_fused nodes). Value inputs are checked against checks (from
+  _get_family_checks); returns None if the program fails these checks or is
+  malformed in a way the structure would not show.
+  """
+  key, side_inputs = [], []
+  # For each node, outputs gives the index in key of its output, or for
+  # ObjectSets whose filter_fused node has not been added yet a tuple
+  # (source, attribute_values) for their chain of filters. A filter used by
+  # several nodes has its chain fused more than once.
+  outputs = []
+  add_key, add_side_inputs, add_output = (key.append, side_inputs.append,
+                                          outputs.append)
+  try:
+    for i, node in enumerate(nodes):
+      node_type = node['type']
+      inputs = node['inputs']
+      values = node.get('side_inputs') or node.get('value_inputs') or ()
+      attribute, allowed = checks[node_type]
+      if attribute is not None:
+        (j,), (value,) = inputs, values
+        if not 0 <= j < i or (allowed is not None and value not in allowed):
+          return None
+        output = outputs[j]
+        if type(output) is tuple:
+          add_output((output[0], output[1] + (attribute, value)))
+        else:
+          add_output((output, (attribute, value)))
+        continue
+
+      if allowed or values:
+        if len(values) != len(allowed):
+          return None
+        for value, value_allowed in zip(values, allowed):
+          if value_allowed is not None and value not in value_allowed:
+            return None
+      family_inputs = []
+      for j in inputs:
+        if not 0 <= j < i:
+          return None
+        output = outputs[j]
+        if type(output) is tuple:
+          add_key(('filter_fused', (output[0],)))
+          add_side_inputs(output[1])
+          output = outputs[j] = len(key) - 1
+        family_inputs.append(output)
+      add_key((node_type, tuple(family_inputs)))
+      add_side_inputs(values)
+      if node_type in object_set_node_types:
+        add_output((len(key) - 1, ()))
+      else:
+        add_output(len(key) - 1)
+  except (KeyError, ValueError):
+    return None
+  if outputs and type(outputs[-1]) is tuple:
+    add_key(('filter_fused', (outputs[-1][0],)))
+    add_side_inputs(outputs[-1][1])
+  return tuple(key), side_inputs
+
+
+def _execute_batch_kernels(batch_kernels, output_types, batch):
+  invalid = [False] * batch.num_scenes
+  outputs = []
+  for kernel, output_type in zip(batch_kernels, output_types):
+    output = kernel(batch, outputs)
+    if output_type != 'ObjectSet':
+      for k, val in enumerate(output):
+        if val == '__INVALID__':
+          invalid[k] = True
+          output[k] = None
+    outputs.append(output)
+
+  answers = outputs[-1]
+  if output_types[-1] == 'ObjectSet':
+    answers = [mask_to_list(mask) for mask in batch.unpack(answers)]
+  return ['__INVALID__' if bad else a for a, bad in zip(answers, invalid)]
+
+
+def execute_batch(compiled_program, scenes):
+  """
+  Execute a CompiledProgram on each of a list of scenes, returning a list with
+  the answer for each scene (the same values CompiledProgram.execute returns).
+  scenes may be a list of scene structs or a SceneBatch; building the batch
+  once and reusing it for several programs amortizes the cost of packing the
+  scenes. Programs using node types without a batched kernel are executed one
+  scene at a time.
+  """
+  if isinstance(scenes, SceneBatch):
+    batch = scenes
+  else:
+    batch = SceneBatch(scenes)
+  batch_kernels = compiled_program.get_batch_kernels()
+  if batch_kernels is None:
+    return [compiled_program.execute(s) for s in batch.scene_structs]
+  if batch.num_scenes == 0:
+    return []
+  return _execute_batch_kernels(batch_kernels, compiled_program.output_types,
+                                batch)
+
+
+def answer_batch(programs, scene_structs, metadata, batch_size=1024):
+  """
+  Answer every one of a group of programs (for example programs from the same
+  template family) on every one of a list of scenes. Returns a list of lists,
+  where the kth list gives the answers of programs[k] on each scene. Programs
+  are optimized with optimize_program before they are compiled.
+  """
+  compiled_programs = [compile_program(optimize_program(p)[0], metadata)
+                       for p in programs]
+  answers = [[] for _ in programs]
+  for start in range(0, len(scene_structs), batch_size):
+    batch = SceneBatch(scene_structs[start:start + batch_size])
+    for compiled_program, program_answers in zip(compiled_programs, answers):
+      program_answers.extend(execute_batch(compiled_program, batch))
+  return answers
+
+
+def answer_questions_batch(programs, scene_structs, metadata, batch_size=1024,
+                           min_family_size=8):
+  """
+  Answer many programs, where programs[k] is answered on scene_structs[k].
+  Programs are grouped into families with the same structure (see
+  _split_program), such as the questions generated from one template, and
+  each family is executed together on all of its scenes, batch_size scenes
+  at a time, with the value inputs of each program carried in its scene's
+  lane. Families with fewer than min_family_size programs, or using node
+  types without batched kernels, are compiled and executed one program at a
+  time, as are programs that _split_program cannot handle. Returns a list of
+  answers in the same order as the inputs.
+
+  As with compile_program, a ValueError is raised for invalid programs; the
+  structure of each family is validated once, and the value inputs of each
+  program are checked while splitting it.
+  """
+  assert len(programs) == len(scene_structs)
+  checks = _get_family_checks(metadata)
+  families, singles = {}, []
+  for k, program in enumerate(programs):
+    split = _split_program(program, checks)
+    if split is None:
+      singles.append(k)
+      continue
+    key, side_inputs = split
+    family = families.get(key)
+    if family is None:
+      family = families[key] = ([], [])
+    family[0].append(k)
+    family[1].append(side_inputs)
+
+  answers = [None] * len(programs)
+  for key, (ks, lane_side_inputs) in families.items():
+    batched = len(ks) >= min_family_size
+    for node_type, inputs in key:
+      if (node_type not in lane_kernel_makers and
+          node_type not in batch_kernel_makers):
+        batched = False
+    for i, (node_type, inputs) in enumerate(key):
+      if (node_type in batch_kernel_makers and node_type not in
+          lane_kernel_makers and lane_side_inputs[0][i]):
+        batched = False
+    if not batched:
+      singles.extend(ks)
+      continue
+    family_nodes = [{'type': node_type, 'inputs': list(inputs),
+                     'side_inputs': side_inputs}
+                    for (node_type, inputs), side_inputs
+                    in zip(key, lane_side_inputs[0])]
+    try:
+      output_types = validate_program(family_nodes, metadata)
+    except ValueError:
+      # Report the problem in terms of the nodes of an actual program
+      validate_program(programs[ks[0]], metadata)
+      raise
+    for start in range(0, len(ks), batch_size):
+      chunk = range(start, min(start + batch_size, len(ks)))
+      batch = SceneBatch([scene_structs[ks[c]] for c in chunk])
+      batch_kernels = []
+      for i, (node_type, inputs) in enumerate(key):
+        if node_type in lane_kernel_makers:
+          make_kernel = lane_kernel_makers[node_type]
+          batch_kernels.append(make_kernel(
+              inputs, [lane_side_inputs[c][i] for c in chunk]))
+        else:
+          make_kernel = batch_kernel_makers[node_type]
+          batch_kernels.append(make_kernel(inputs, []))
+      chunk_answers = _execute_batch_kernels(batch_kernels, output_types,
+                                             batch)
+      for c, a in zip(chunk, chunk_answers):
+        answers[ks[c]] = a
+  for k in singles:
+    compiled_program = compile_program(programs[k], metadata)
+    answers[k] = compiled_program.execute(scene_structs[k])
+  return answers
+
+
+def merge_programs(programs):
+  """
+  Merge several programs into a single DAG, sharing common subexpressions: two
+  nodes are merged iff they have the same type and value inputs and their
+  inputs were merged. Since programs are topologically sorted, so is the
+  merged DAG.
+
+  Returns a tuple (nodes, program_node_idxs) where nodes is the merged list of
+  nodes and program_node_idxs[k][i] is the index in nodes of the ith node of
+  the kth program.
+  """
+  nodes, node_idxs_by_key = [], {}
+  program_node_idxs = []
+  for program in programs:
+    node_idxs = []
+    for node in program:
+      side_inputs = node.get('side_inputs', node.get('value_inputs', []))
+      inputs = [node_idxs[idx] for idx in node['inputs']]
+      key = (node['type'], tuple(side_inputs), tuple(inputs))
+      if key not in node_idxs_by_key:
+        node_idxs_by_key[key] = len(nodes)
+        nodes.append({
+          'type': node['type'],
+          'inputs': inputs,
+          'side_inputs': list(side_inputs),
+        })
+      node_idxs.append(node_idxs_by_key[key])
+    program_node_idxs.append(node_idxs)
+  return nodes, program_node_idxs
+
+
+def answer_questions(programs, metadata, scene_struct, all_outputs=False):
+  """
+  Answer several programs on the same scene, for example all of the questions
+  generated for one image. The programs are merged with merge_programs so that
+  each distinct sub-program is evaluated only once, however many programs
+  share it. Returns a list with the result for each program, which is the same
+  as what answer_question would return for it. If all_outputs is False then
+  filter chains used by only one program are short-circuited, as in
+  answer_question with lazy=True.
+  """
+  nodes, program_node_idxs = merge_programs(programs)
+  # The last node of a program may be shared with (and be a filter feeding a
+  # consumer in) a longer program, as for [scene, filter_color] and [scene,
+  # filter_color, exist]; it must not be skipped by short-circuiting
+  output_idxs = set(node_idxs[-1] for node_idxs in program_node_idxs)
+  compiled_program = compile_program(nodes, metadata, lazy=not all_outputs,
+                                     output_idxs=output_idxs)
+  outputs = compiled_program.execute_dag_masks(scene_struct)
+  output_types = compiled_program.output_types
+
+  converted = {}
+  def get_output(i):
+    if output_types[i] != 'ObjectSet' or outputs[i] == '__INVALID__':
+      return outputs[i]
+    if i not in converted:
+      converted[i] = mask_to_list(outputs[i])
+    return converted[i]
+
+  results = []
+  for node_idxs in program_node_idxs:
+    # As in answer_question, a program stops at its first invalid node
+    program_outputs = []
+    for i in node_idxs:
+      if outputs[i] == '__INVALID__':
+        program_outputs.append('__INVALID__')
+        break
+      if all_outputs:
+        program_outputs.append(get_output(i))
+    if all_outputs:
+      results.append(program_outputs)
+    elif program_outputs:
+      results.append(program_outputs[-1])
+    else:
+      results.append(get_output(node_idxs[-1]))
+  return results
@@ -0,0 +1,160 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, os, queue, threading
+
+"""
+Writing generated questions to disk as they are produced.
+
+Questions can be written either in the single-file format of the CLEVR release,
+{"info": {...}, "questions": [...]}, or as JSON Lines, where the first line is
+{"info": {...}} and each following line holds one question. The single-file
+format is written incrementally, and is byte-for-byte the same as writing the
+whole dataset with one json.dump; JSON Lines files remain readable if the run
+dies partway through, and can be converted to the single-file format with
+assemble_questions.py.
+"""
+
+
+def convert_program(program):
+  """
+  Return a copy of a program with "side_inputs" changed to "value_inputs".
+
+  My original name for these was "side_inputs" but I decided to change the
+  name to "value_inputs" for the public CLEVR release. I should probably go
+  through all question generation code and templates and rename, but that
+  could be tricky and take a while, so instead I'll just do it here. To further
+  complicate things, originally functions without value inputs did not have a
+  "side_inputs" field at all, and I'm pretty sure this fact is used in some of
+  the question generation code; however in the public CLEVR release all
+  functions have a "value_inputs" field, and it's an empty list for functions
+  that take no value inputs. Again this should probably be refactored, but the
+  quick and dirty solution is to keep the generation code as-is, but here make
+  "value_inputs" an empty list for those functions that do not have
+  "side_inputs". Gross.
+
+  Nodes are copied rather than modified in place, since they may be shared
+  with templates and with states of the search that is still running.
+  """
+  new_program = []
+  for f in program:
+    new_f = {k: v for k, v in f.items() if k != 'side_inputs'}
+    new_f['value_inputs'] = f.get('side_inputs', [])
+    new_program.append(new_f)
+  return new_program
+
+
+class QuestionWriter(object):
+  """
+  Writes questions to filename as they are generated. Questions are encoded
+  and written on a background thread, through a queue of at most max_queued
+  questions, so that generation does not wait on the disk. The format is
+  chosen by the extension of filename: JSON Lines for ".jsonl", and the
+  single-file format otherwise.
+
+  write assigns each question its question_index and converts its program
+  with convert_program; close must be called to finish the file. Errors raised
+  on the background thread are raised again by the next call to write or
+  close.
+
+  To continue a file that was partially written by an earlier run, pass the
+  state returned by get_state at that point as resume_state; anything
+  written to the file after that point is discarded.
+  """
+  def __init__(self, filename, info, max_queued=4096, buffer_size=2 ** 20,
+               resume_state=None):
+    self.filename = filename
+    self.jsonl = filename.endswith('.jsonl')
+    self.error = None
+    if resume_state is None:
+      self.num_questions = 0
+      self.num_written = 0
+      self.f = open(filename, 'w', buffering=buffer_size)
+      if self.jsonl:
+        self.f.write(json.dumps({'info': info}))
+        self.f.write('\n')
+      else:
+        self.f.write('{"info": %s, "questions": [' % json.dumps(info))
+    else:
+      self.num_questions = resume_state['num_questions']
+      self.num_written = resume_state['num_questions']
+      self.f = open(filename, 'r+', buffering=buffer_size)
+      self.f.seek(resume_state['offset'])
+      self.f.truncate()
+    self.queue = queue.Queue(max_queued)
+    self.thread = threading.Thread(target=self._write_loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _write_loop(self):
+    while True:
+      question = self.queue.get()
+      if question is None:
+        break
+      if self.error is not None:
+        continue
+      try:
+        s = json.dumps(question)
+        if self.jsonl:
+          self.f.write(s)
+          self.f.write('\n')
+        else:
+          if self.num_written > 0:
+            self.f.write(', ')
+          self.f.write(s)
+        self.num_written += 1
+      except Exception as e:
+        self.error = e
+
+  def _check_error(self):
+    if self.error is not None:
+      raise self.error
+
+  def write(self, question):
+    self._check_error()
+    question['question_index'] = self.num_questions
+    question['program'] = convert_program(question['program'])
+    self.num_questions += 1
+    self.queue.put(question)
+
+  def flush(self):
+    """
+    Wait until all questions passed to write have been written to the file.
+    """
+    self.queue.put(None)
+    self.thread.join()
+    self._check_error()
+    self.f.flush()
+    self.thread = threading.Thread(target=self._write_loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def get_state(self):
+    """
+    Flush the file to disk and return a dict describing how much of it has
+    been written, which can be passed as resume_state to continue it later.
+    """
+    self.flush()
+    os.fsync(self.f.fileno())
+    return {'num_questions': self.num_questions, 'offset': self.f.tell()}
+
+  def close(self, sync=False):
+    """
+    Finish the file and close it; if sync is True then also make sure that it
+    has reached the disk before returning.
+    """
+    self.queue.put(None)
+    self.thread.join()
+    try:
+      self._check_error()
+      if not self.jsonl:
+        self.f.write(']}')
+      if sync:
+        self.f.flush()
+        os.fsync(self.f.fileno())
+    finally:
+      self.f.close()
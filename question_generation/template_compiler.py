@@ -0,0 +1,285 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import hashlib, json, os, pickle, re
+
+"""
+Loading and compiling question templates.
+
+Templates are JSON objects as described in README.md. Before instantiating a
+template, generate_questions.py needs to know the type of each parameter, how
+each special node of the program template expands, which constraints apply
+and how the text templates are split into words, parameters and optional
+segments. None of this depends on the scene, so it is worked out once per
+template by compiling it into a CompiledTemplate.
+
+Compiled templates are cached on disk, so that short jobs that only generate
+questions for a few scenes do not need to parse and compile all templates
+again. The cache records the modification time and size of each template
+file and a hash of the metadata, and templates are recompiled whenever any
+of these change. Since the cache is a pickle, which can run arbitrary code
+when it is loaded, it is kept by default in the user's own cache directory
+rather than next to the templates (see get_default_cache_file).
+"""
+
+
+# Increase this when CompiledTemplate changes, to invalidate existing caches
+CACHE_VERSION = 3
+
+# Special template nodes, which expand into a sequence of filter nodes
+# (preceded by a relate node for relate_filter*, and followed by the node
+# given here, if any)
+special_node_extra_types = {
+  'filter': None,
+  'filter_unique': 'unique',
+  'filter_count': 'count',
+  'filter_exist': 'exist',
+  'relate_filter': None,
+  'relate_filter_unique': 'unique',
+  'relate_filter_count': 'count',
+  'relate_filter_exist': 'exist',
+}
+
+_param_pattern = re.compile(r'(<[^<>]*>)')
+
+
+def get_null_value(param_type, metadata):
+  """
+  Return the text used for a parameter of type param_type whose value is NULL.
+  """
+  if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
+    return 'thing'
+  return ''
+
+
+def tokenize_text(text):
+  """
+  Split a text template into a list of segments (optional, parts), where
+  optional is True for segments surrounded by square brackets, and parts is a
+  list of tuples (is_param, s) giving the literal text and the parameter names
+  in the segment in order. Returns None if the brackets in text are nested or
+  unbalanced, in which case the text must be handled by replace_optionals in
+  generate_questions.py instead.
+  """
+  segments = []
+  optional = False
+  for piece in re.split(r'([\[\]])', text):
+    if piece == '[':
+      if optional:
+        return None
+      optional = True
+      continue
+    if piece == ']':
+      if not optional:
+        return None
+      optional = False
+      continue
+    parts = []
+    for i, s in enumerate(_param_pattern.split(piece)):
+      if s:
+        parts.append((i % 2 == 1, s))
+    segments.append((optional, parts))
+  if optional:
+    return None
+  return segments
+
+
+def compile_node(node, param_types, metadata):
+  """
+  Return a dict describing how a node of a program template is expanded
+  during instantiation. Its 'kind' is 'special' for nodes that expand into
+  several functions, 'param' for nodes with a single template parameter, and
+  'plain' for all other nodes.
+  """
+  node_type = node['type']
+  if node_type in special_node_extra_types:
+    side_inputs = node['side_inputs']
+    relate_param = None
+    if node_type.startswith('relate'):
+      relate_param = side_inputs[0]  # First one should be relate
+      assert param_types[relate_param] == 'Relation'
+      side_inputs = side_inputs[1:]
+    filter_params = []
+    for param_name in side_inputs:
+      param_type = param_types[param_name]
+      filter_params.append((param_name, 'filter_%s' % param_type.lower(),
+                            get_null_value(param_type, metadata)))
+    return {
+      'kind': 'special',
+      'type': node_type,
+      'relate_param': relate_param,
+      'unique': node_type == 'relate_filter_unique',
+      'include_zero': node_type in ('relate_filter_count',
+                                    'relate_filter_exist'),
+      'filter_params': filter_params,
+      'extra_type': special_node_extra_types[node_type],
+    }
+  if 'side_inputs' in node:
+    # TODO: Generalize this to work for nodes with more than one side input
+    assert len(node['side_inputs']) == 1, 'NOT IMPLEMENTED'
+    param_name = node['side_inputs'][0]
+    return {
+      'kind': 'param',
+      'param_name': param_name,
+      'param_vals': metadata['types'][param_types[param_name]],
+    }
+  return {'kind': 'plain'}
+
+
+def compile_constraint(constraint, param_types, metadata):
+  """
+  Return a constraint as a tuple: ('NEQ', p1, p2), ('NULL', p, null_value)
+  or ('OUT_NEQ', i, j), where null_value is given by get_null_value.
+  """
+  if constraint['type'] == 'NEQ':
+    p1, p2 = constraint['params']
+    return ('NEQ', p1, p2)
+  elif constraint['type'] == 'NULL':
+    p = constraint['params'][0]
+    null_value = get_null_value(param_types[p], metadata)
+    return ('NULL', p, null_value)
+  elif constraint['type'] == 'OUT_NEQ':
+    i, j = constraint['params']
+    return ('OUT_NEQ', i, j)
+  assert False, 'Unrecognized constraint type "%s"' % constraint['type']
+
+
+class CompiledTemplate(object):
+  """
+  A template together with everything about it that instantiate_templates_dfs
+  needs and that does not depend on the scene. The fields of the template
+  are available as attributes (nodes, params, text and constraints), and in
+  addition:
+
+  - param_types maps parameter names to their types
+  - expansions gives compile_node for each node of the program template
+  - compiled_constraints gives compile_constraint for each constraint
+  - param_constraints maps each parameter to the NEQ and NULL constraints on
+    it, which can be checked as soon as it is assigned a value
+  - output_constraints maps each template node i to the list of template
+    nodes j < i whose output must differ from that of i (from OUT_NEQ
+    constraints), which can be checked as soon as i is expanded
+  - text_templates gives tuples (text, tokenize_text(text)) for each text
+    template
+  - has_relate is True if the program template has a raw relate node, in
+    which case instantiated questions must be checked for degeneracy
+  """
+  def __init__(self, template, metadata):
+    self.template = template
+    self.nodes = template['nodes']
+    self.params = template['params']
+    self.text = template['text']
+    self.constraints = template['constraints']
+    self.param_types = {p['name']: p['type'] for p in self.params}
+    self.expansions = [compile_node(n, self.param_types, metadata)
+                       for n in self.nodes]
+    self.compiled_constraints = [compile_constraint(c, self.param_types,
+                                                    metadata)
+                                 for c in self.constraints]
+    self.param_constraints = {}
+    self.output_constraints = {}
+    for constraint in self.compiled_constraints:
+      if constraint[0] == 'OUT_NEQ':
+        i, j = sorted(constraint[1:])
+        self.output_constraints.setdefault(j, []).append(i)
+      elif constraint[0] == 'NEQ':
+        for p in constraint[1:]:
+          self.param_constraints.setdefault(p, []).append(constraint)
+      else:
+        self.param_constraints.setdefault(constraint[1], []).append(constraint)
+    self.text_templates = [(t, tokenize_text(t)) for t in self.text]
+    self.has_relate = any(n['type'] == 'relate' for n in self.nodes)
+
+
+def get_metadata_hash(metadata):
+  # Keys starting with an underscore are added while running
+  metadata = {k: v for k, v in metadata.items() if not k.startswith('_')}
+  s = json.dumps(metadata, sort_keys=True).encode('utf-8')
+  return hashlib.sha1(s).hexdigest()
+
+
+def get_default_cache_file(template_dir):
+  """
+  Return the default cache file for the templates in template_dir. It is in
+  the directory clevr_question_generation of the user's cache directory
+  ($XDG_CACHE_HOME, or ~/.cache if that is not set), and its name includes a
+  hash of the absolute path of template_dir, so that different template
+  directories do not share a cache.
+  """
+  cache_dir = os.environ.get('XDG_CACHE_HOME')
+  if not cache_dir:
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache')
+  path = os.path.abspath(template_dir).encode('utf-8')
+  filename = 'templates_%s.pkl' % hashlib.sha1(path).hexdigest()[:16]
+  return os.path.join(cache_dir, 'clevr_question_generation', filename)
+
+
+def _read_cache(cache_file, metadata_hash):
+  try:
+    with open(cache_file, 'rb') as f:
+      cache = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+          ImportError):
+    return {}
+  if (not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION
+      or cache.get('metadata_hash') != metadata_hash):
+    return {}
+  return cache['files']
+
+
+def _write_cache(cache_file, metadata_hash, files):
+  cache = {
+    'version': CACHE_VERSION,
+    'metadata_hash': metadata_hash,
+    'files': files,
+  }
+  tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+  try:
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir, mode=0o700)
+    with open(tmp_file, 'wb') as f:
+      pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+  except OSError as e:
+    print('Could not write template cache %s: %s' % (cache_file, e))
+
+
+def load_templates(template_dir, metadata, cache_file=None):
+  """
+  Load and compile all templates in the JSON files in template_dir. Returns a
+  dict mapping (filename, index in file) to a CompiledTemplate, in the order
+  given by os.listdir. If cache_file is given then compiled templates are
+  read from it when their file has not changed, and it is updated if any
+  templates had to be compiled.
+  """
+  metadata_hash = get_metadata_hash(metadata)
+  cached_files = {}
+  if cache_file is not None:
+    cached_files = _read_cache(cache_file, metadata_hash)
+
+  templates = {}
+  files = {}
+  changed = False
+  for fn in os.listdir(template_dir):
+    if not fn.endswith('.json'): continue
+    path = os.path.join(template_dir, fn)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = cached_files.get(fn)
+    if cached is not None and cached[0] == stamp:
+      compiled = cached[1]
+    else:
+      with open(path, 'r') as f:
+        compiled = [CompiledTemplate(t, metadata) for t in json.load(f)]
+      changed = True
+    files[fn] = (stamp, compiled)
+    for i, template in enumerate(compiled):
+      templates[(fn, i)] = template
+  if cache_file is not None and (changed or set(files) != set(cached_files)):
+    _write_cache(cache_file, metadata_hash, files)
+  return templates
@@ -0,0 +1,354 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, time
+from collections import deque
+import multiprocessing
+
+import question_engine as qeng
+import json_stream
+import template_compiler
+
+"""
+Verify a questions file against the scenes it was generated from.
+
+Every program in the questions file (in the format written by
+generate_questions.py, using "value_inputs") is re-executed on its scene with
+the question engine, and we report questions whose answer does not match,
+questions whose programs are invalid (either malformed or failing during
+execution), and questions that are degenerate. As in generate_questions.py,
+only questions from templates with a raw relate node are checked for
+degeneracy; templates are looked up in --template_dir by the
+template_filename and question_family_index of each question, and questions
+whose template cannot be found are always checked.
+
+Both input files are read incrementally, so memory use does not grow with the
+size of the dataset; questions must appear in the same order as their scenes
+(which is how generate_questions.py writes them), and questions whose scene
+comes before the scenes already read are reported as missing_scene. Work is split into
+chunks of consecutive scenes and distributed across a pool of processes; all
+of the questions for a scene are answered together with
+question_engine.answer_questions, which evaluates shared sub-programs once.
+"""
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
+    help="JSON file containing ground-truth scene information for all images " +
+         "from render_images.py; may also be a JSON Lines file or a " +
+         "directory of per-scene JSON files")
+parser.add_argument('--input_questions_file',
+    default='../output/CLEVR_questions.json',
+    help="JSON or JSON Lines file containing questions, programs and " +
+         "answers from generate_questions.py")
+parser.add_argument('--metadata_file', default='metadata.json',
+    help="JSON file containing metadata about functions")
+parser.add_argument('--template_dir', default='CLEVR_1.0_templates',
+    help="Directory containing the JSON templates the questions were " +
+         "generated from, used to decide which questions to check for " +
+         "degeneracy")
+parser.add_argument('--num_workers', default=0, type=int,
+    help="Number of worker processes; if 0 then verify in this process")
+parser.add_argument('--scenes_per_chunk', default=64, type=int,
+    help="Number of scenes sent to a worker at once")
+parser.add_argument('--max_outstanding_chunks', default=0, type=int,
+    help="Maximum number of chunks queued for the workers at once; " +
+         "defaults to four per worker")
+parser.add_argument('--skip_degenerate', action='store_true',
+    help="If given then do not check whether questions are degenerate")
+parser.add_argument('--report_every', default=10000, type=int,
+    help="Print progress after about this many questions")
+parser.add_argument('--output_file', default=None,
+    help="If given, write a JSON list of all problems found to this file")
+
+
+def program_to_nodes(program):
+  """
+  Convert a program from the released format (with "value_inputs" for every
+  function) to the format used by question generation, where only functions
+  with value inputs have "side_inputs".
+  """
+  nodes = []
+  for f in program:
+    node = {'type': f['type'], 'inputs': f['inputs']}
+    side_inputs = f.get('value_inputs', f.get('side_inputs'))
+    if side_inputs:
+      node['side_inputs'] = side_inputs
+    nodes.append(node)
+  return nodes
+
+
+def get_template_key(q):
+  return (q.get('template_filename'), q.get('question_family_index'))
+
+
+def load_relate_templates(template_dir, metadata):
+  """
+  Return a dict mapping (template_filename, question_family_index) for every
+  template in template_dir to whether it has a raw relate node, which is
+  when generate_questions.py checks its questions for degeneracy.
+  """
+  templates = template_compiler.load_templates(template_dir, metadata)
+  return {key: template.has_relate for key, template in templates.items()}
+
+
+def verify_scene(scene_struct, questions, metadata, check_degenerate=True,
+                 relate_templates=None):
+  """
+  Re-answer all of the questions for one scene. Returns a tuple (counts,
+  problems) where counts maps each kind of result ('ok', 'mismatch',
+  'invalid', 'degenerate') to a number of questions and problems is a list of
+  dicts describing the questions that were not ok. If relate_templates is
+  given (as returned by load_relate_templates) then questions from templates
+  without a relate node are not checked for degeneracy.
+  """
+  if relate_templates is None:
+    relate_templates = {}
+  counts = {'ok': 0, 'mismatch': 0, 'invalid': 0, 'degenerate': 0}
+  problems = []
+  def add_problem(q, kind, **kwargs):
+    counts[kind] += 1
+    problem = {
+      'kind': kind,
+      'question_index': q.get('question_index'),
+      'image_filename': q.get('image_filename'),
+    }
+    problem.update(kwargs)
+    problems.append(problem)
+
+  # Malformed programs would make the merged program fail to compile, so they
+  # are checked one at a time before answering the rest together. The outputs
+  # of every node are only needed to check for degeneracy; other questions are
+  # answered lazily.
+  checked_questions, checked_programs = [], []
+  other_questions, other_programs = [], []
+  for q in questions:
+    nodes = program_to_nodes(q['program'])
+    try:
+      qeng.validate_program(nodes, metadata)
+    except ValueError as e:
+      add_problem(q, 'invalid', error=str(e))
+      continue
+    if (check_degenerate and relate_templates.get(get_template_key(q), True)
+        and any(node['type'] == 'relate' for node in nodes)):
+      checked_questions.append(q)
+      checked_programs.append(nodes)
+    else:
+      other_questions.append(q)
+      other_programs.append(nodes)
+
+  def check_answer(q, answer):
+    if answer == '__INVALID__':
+      add_problem(q, 'invalid', error='program is invalid on its scene')
+    elif answer != q['answer']:
+      add_problem(q, 'mismatch', expected=q['answer'], answer=answer)
+    else:
+      return True
+    return False
+
+  all_outputs = qeng.answer_questions(checked_programs, metadata,
+                                      scene_struct, all_outputs=True)
+  for q, nodes, outputs in zip(checked_questions, checked_programs,
+                               all_outputs):
+    answer = outputs[-1]
+    if not check_answer(q, answer):
+      continue
+    if qeng.is_degenerate({'nodes': nodes}, metadata, scene_struct,
+                          answer=answer, outputs=outputs):
+      add_problem(q, 'degenerate')
+    else:
+      counts['ok'] += 1
+  answers = qeng.answer_questions(other_programs, metadata, scene_struct)
+  for q, answer in zip(other_questions, answers):
+    if check_answer(q, answer):
+      counts['ok'] += 1
+  return counts, problems
+
+
+def verify_chunk(chunk, metadata, check_degenerate=True,
+                 relate_templates=None):
+  """
+  Verify a list of (scene_struct, questions) pairs, returning a tuple
+  (counts, problems) as for verify_scene. Scenes that could not be found are
+  given as None, and all of their questions are reported as missing.
+  """
+  counts = {'ok': 0, 'mismatch': 0, 'invalid': 0, 'degenerate': 0,
+            'missing_scene': 0}
+  problems = []
+  for scene_struct, questions in chunk:
+    if scene_struct is None:
+      counts['missing_scene'] += len(questions)
+      for q in questions:
+        problems.append({
+          'kind': 'missing_scene',
+          'question_index': q.get('question_index'),
+          'image_index': q.get('image_index'),
+          'image_filename': q.get('image_filename'),
+        })
+      continue
+    scene_counts, scene_problems = verify_scene(scene_struct, questions,
+                                                metadata, check_degenerate,
+                                                relate_templates)
+    for kind, count in scene_counts.items():
+      counts[kind] += count
+    problems.extend(scene_problems)
+  return counts, problems
+
+
+def iter_questions(questions_file):
+  if questions_file.endswith('.jsonl'):
+    questions = json_stream.iter_jsonl(questions_file)
+    next(questions, None)  # The first line holds the info
+    return questions
+  return json_stream.iter_json_array(questions_file, 'questions')
+
+
+def iter_scene_questions(scene_file, questions_file):
+  """
+  Stream the scene and question files in parallel, yielding tuples
+  (scene_struct, questions) for each run of consecutive questions about the
+  same scene, matched by image_index; scene_struct is None if the scene does
+  not appear in the scene file.
+
+  Questions must appear in the same order as their scenes. Scenes read ahead
+  while searching for a question's scene are kept until the questions move
+  past them, and the scene file is never searched again: a question whose
+  scene is not found ahead of the scenes read so far gets None.
+  """
+  scenes = json_stream.load_scenes(scene_file)[1]
+  state = {'last_index': None}
+  pending_scenes = {}
+
+  def find_scene(image_index):
+    for index in [i for i in pending_scenes if i < image_index]:
+      del pending_scenes[index]
+    if image_index in pending_scenes:
+      return pending_scenes.pop(image_index)
+    last_index = state['last_index']
+    if last_index is not None and image_index <= last_index:
+      return None
+    for scene_struct in scenes:
+      index = state['last_index'] = scene_struct['image_index']
+      if index == image_index:
+        return scene_struct
+      if index > image_index:
+        pending_scenes[index] = scene_struct
+    return None
+
+  cur_index, cur_questions = None, []
+  for q in iter_questions(questions_file):
+    if q['image_index'] != cur_index and cur_questions:
+      yield find_scene(cur_index), cur_questions
+      cur_questions = []
+    cur_index = q['image_index']
+    cur_questions.append(q)
+  if cur_questions:
+    yield find_scene(cur_index), cur_questions
+
+
+def iter_chunks(items, chunk_size):
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) == chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+# Metadata and templates used by verify_chunk in worker processes; set by
+# _init_worker so that they are not sent along with every chunk.
+_worker_metadata = None
+_worker_relate_templates = None
+
+
+def _init_worker(metadata, relate_templates):
+  global _worker_metadata, _worker_relate_templates
+  _worker_metadata = metadata
+  _worker_relate_templates = relate_templates
+
+
+def _verify_chunk_in_worker(chunk, check_degenerate):
+  return verify_chunk(chunk, _worker_metadata, check_degenerate,
+                      _worker_relate_templates)
+
+
+def main(args):
+  with open(args.metadata_file, 'r') as f:
+    metadata = json.load(f)
+  check_degenerate = not args.skip_degenerate
+  relate_templates = None
+  if check_degenerate:
+    relate_templates = load_relate_templates(args.template_dir, metadata)
+
+  counts = {'ok': 0, 'mismatch': 0, 'invalid': 0, 'degenerate': 0,
+            'missing_scene': 0}
+  problems = []
+  tic = time.time()
+  state = {'num_questions': 0, 'last_report': 0}
+
+  def add_results(results):
+    chunk_counts, chunk_problems = results
+    for kind, count in chunk_counts.items():
+      counts[kind] += count
+    problems.extend(chunk_problems)
+    state['num_questions'] += sum(chunk_counts.values())
+    if state['num_questions'] - state['last_report'] >= args.report_every:
+      state['last_report'] = state['num_questions']
+      elapsed = time.time() - tic
+      print('verified %d questions in %.1fs (%.1f questions / s)'
+            % (state['num_questions'], elapsed,
+               state['num_questions'] / max(elapsed, 1e-6)))
+
+  chunks = iter_chunks(iter_scene_questions(args.input_scene_file,
+                                            args.input_questions_file),
+                       args.scenes_per_chunk)
+  if args.num_workers == 0:
+    for chunk in chunks:
+      add_results(verify_chunk(chunk, metadata, check_degenerate,
+                               relate_templates))
+  else:
+    # Pool.imap would read the whole input ahead of the workers, so instead
+    # we submit chunks one at a time and bound the number in flight
+    max_outstanding = args.max_outstanding_chunks or 4 * args.num_workers
+    pool = multiprocessing.Pool(args.num_workers, initializer=_init_worker,
+                                initargs=(metadata, relate_templates))
+    try:
+      outstanding = deque()
+      for chunk in chunks:
+        if len(outstanding) >= max_outstanding:
+          add_results(outstanding.popleft().get())
+        outstanding.append(pool.apply_async(_verify_chunk_in_worker,
+                                            (chunk, check_degenerate)))
+      while outstanding:
+        add_results(outstanding.popleft().get())
+    finally:
+      pool.terminate()
+      pool.join()
+
+  elapsed = time.time() - tic
+  num_questions = state['num_questions']
+  print('Verified %d questions in %.1fs (%.1f questions / s)'
+        % (num_questions, elapsed, num_questions / max(elapsed, 1e-6)))
+  for kind in ['ok', 'mismatch', 'invalid', 'degenerate', 'missing_scene']:
+    print('%-14s %d' % (kind, counts[kind]))
+  for problem in problems[:10]:
+    print(problem)
+  if len(problems) > 10:
+    print('... and %d more problems' % (len(problems) - 10))
+
+  if args.output_file is not None:
+    with open(args.output_file, 'w') as f:
+      json.dump(problems, f)
+  return counts
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)